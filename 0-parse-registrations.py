@@ -1,47 +1,173 @@
 # This script converts each copyright registration record from XML to
 # JSON, with a minimum of processing.
-import json
-from pdb import set_trace
+#
+# Usage: python 0-parse-registrations.py [number of processes]
+#
+# With more than one process, each XML volume is parsed in a separate
+# worker, but the output is written in the same order as a
+# single-process run, so the output file is identical either way.
+#
+# The parsed form of each volume is kept in CACHE_DIR, under a hash of
+# the volume's contents and of the parsing code. A volume that hasn't
+# changed since the last run isn't parsed again.
+import hashlib
+import codec
 import os
+import sys
 from collections import defaultdict
+from multiprocessing import Pool
 from lxml import etree
+from metrics import Metrics
+import model
 from model import Registration
-import time
+
+CACHE_DIR = "output/0-parsed-registrations-cache"
+
+def parser_version():
+    """A stamp that changes whenever the parsing or serialization code
+    changes.
+    """
+    version = hashlib.sha1()
+    for path in (model.__file__, codec.__file__, __file__):
+        with open(path, "rb") as f:
+            version.update(f.read())
+    return version.hexdigest()
 
 class Parser(object):
 
-    def __init__(self):
-        self.parser = etree.XMLParser(recover=True)
-        self.count = 0
+    def __init__(self, cache_dir=CACHE_DIR, metrics=None):
+        self.metrics = metrics or Metrics()
         self.seen_tags = set()
         self.seen_publisher_tags = set()
+        self.cache_dir = cache_dir
+        self.version = parser_version()
 
-    def process_directory_tree(self, path):
-        before = time.time()
+    def files(self, path):
+        """Find all the XML volumes beneath `path`, in the order
+        os.walk finds them.
+        """
         for dir, subdirs, files in os.walk(path):
             if 'alto' in subdirs:
                 subdirs.remove('alto')
             for i in files:
                 if not i.endswith('xml'):
                     continue
-                for entry in self.process_file(os.path.join(dir, i)):
-                    yield entry
-                    self.count += 1
-                    if not (self.count % 10000):
-                        after = time.time()
-                        print("%d %.2fsec" % (self.count, after-before))
-                        before = after
-                        after = None
-
-    def process_file(self, path):
-        tree = etree.parse(open(path), self.parser)
-        for e in tree.xpath("//copyrightEntry"):
-            for registration in Registration.from_tag(e, include_extra=False):
+                yield os.path.join(dir, i)
+
+    def shard_path(self, path):
+        """Where the parsed form of the volume at `path` is cached."""
+        key = hashlib.sha1(self.version.encode("ascii"))
+        with open(path, "rb") as f:
+            key.update(f.read())
+        return os.path.join(self.cache_dir, key.hexdigest() + ".ndjson")
+
+    def process_directory_tree(self, path, processes=1):
+        """Parse every volume beneath `path`, unless its parsed form
+        is already cached.
+
+        :yield: One line of JSON (including the newline) for every
+            registration found, in the order the volumes were found.
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        volumes = [(x, self.shard_path(x)) for x in self.files(path)]
+        todo = [x for x in volumes if not os.path.exists(x[1])]
+        print("%d volumes, %d need parsing." % (len(volumes), len(todo)))
+        if processes > 1:
+            pool = Pool(processes)
+            parsed = pool.imap(parse_volume, todo)
+        else:
+            pool = None
+            parsed = (parse_volume(x) for x in todo)
+
+        todo = set(todo)
+        for volume in volumes:
+            if volume in todo:
+                # Wait for this volume to be parsed.
+                with self.metrics.phase("parse"):
+                    next(parsed)
+            path, shard = volume
+            count = 0
+            for line in open(shard):
+                yield line
+                count += 1
+                self.metrics.record()
+            self.metrics.gauge("registrations per volume", count)
+        if pool:
+            pool.close()
+            pool.join()
+        self.prune(set(shard for path, shard in volumes))
+
+    def prune(self, keep):
+        """Remove cached volumes that weren't used in this run --
+        volumes that have since changed or been removed, or that were
+        parsed with old code.
+
+        Only finished volumes are removed. Partial files (see
+        parse_volume) may belong to another run that's still going.
+        """
+        for i in os.listdir(self.cache_dir):
+            shard = os.path.join(self.cache_dir, i)
+            if i.endswith(".ndjson") and shard not in keep:
+                os.remove(shard)
+
+    @classmethod
+    def process_file(cls, path):
+        for e in cls.entries(path):
+            for registration in Registration.from_tag(
+                e, include_extra=False, single_pass=True
+            ):
                 yield registration.jsonable()
 
-if not os.path.exists("output"):
-    os.mkdir("output")
-output = open("output/0-parsed-registrations.ndjson", "w")
-for parsed in Parser().process_directory_tree("registrations/xml"):
-        json.dump(parsed, output)
-        output.write("\n")
+    @classmethod
+    def entries(cls, path):
+        """Stream the <copyrightEntry> tags out of a volume.
+
+        Each tag is yielded once it's been completely parsed, and
+        thrown away (along with anything that came before it) once
+        the caller is done with it, so only one entry at a time is
+        kept in memory rather than the whole volume.
+        """
+        for event, e in etree.iterparse(
+            path, events=("end",), tag="copyrightEntry", recover=True
+        ):
+            yield e
+            e.clear()
+            while e.getprevious() is not None:
+                del e.getparent()[0]
+
+def parse_volume(volume):
+    """Parse one volume and cache the result.
+
+    Each registration is written out as soon as it's parsed, so the
+    volume is never held in memory all at once. It's written to a
+    partial file first, so an interrupted run never leaves a
+    half-written volume in the cache.
+
+    This may run inside a worker process.
+    """
+    path, shard = volume
+    partial = "%s.%d" % (shard, os.getpid())
+    with open(partial, "w") as out:
+        for registration in Parser.process_file(path):
+            out.write(codec.dumps(registration))
+            out.write("\n")
+    os.replace(partial, shard)
+    return shard
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    else:
+        processes = 1
+    if not os.path.exists("output"):
+        os.mkdir("output")
+    output = open("output/0-parsed-registrations.ndjson", "w")
+    metrics = Metrics("0-parse-registrations")
+    parser = Parser(metrics=metrics)
+    write = metrics.phase("write")
+    for line in parser.process_directory_tree("registrations/xml", processes):
+        with write:
+            output.write(line)
+    output.close()
+    metrics.finish()
@@ -1,17 +1,18 @@
 # This script converts each copyright renewal record from CSV to
 # a JSON format similar to (but much simpler than) that created by
 # 0-parse-registrations.py.
-import json
-from pdb import set_trace
+import codec
 import os
 from csv import DictReader
 from collections import defaultdict
 from model import Renewal
+from compare import RenewalIndex
+from metrics import Metrics
 
 class Parser(object):
 
-    def __init__(self):
-        self.count = 0
+    def __init__(self, metrics=None):
+        self.metrics = metrics or Metrics()
         self.cross_references = defaultdict(list)
         
     def process_directory_tree(self, path):
@@ -22,16 +23,35 @@ class Parser(object):
                 continue
             for entry in self.process_file(os.path.join(path, i)):
                 yield entry
-                self.count += 1
-        print(self.count)
+                self.metrics.record()
+        print(self.metrics.count)
 
     def process_file(self, path):
+        parse = self.metrics.phase("parse")
         for line in DictReader(open(path), dialect='excel-tab'):
-            yield Renewal.from_dict(line)
+            with parse:
+                renewal = Renewal.from_dict(line)
+            yield renewal
             
+def write(renewals, output, metrics):
+    phase = metrics.phase("write")
+    for renewal in renewals:
+        with phase:
+            codec.dump(renewal.jsonable(), output)
+        yield renewal
+    # Close the output before the index is finished, so the index is
+    # never older than the file it indexes.
+    output.close()
+
 output = open("output/1-parsed-renewals.ndjson", "w")
-parser = Parser()
-for parsed in parser.process_directory_tree("renewals/data"):
-        json.dump(parsed.jsonable(), output)
-        output.write("\n")
+metrics = Metrics("1-parse-renewals")
+parser = Parser(metrics)
+renewals = parser.process_directory_tree("renewals/data")
+
+# While writing out the renewals, build an index that will let
+# 2-match-renewals.py look them up without loading them all.
+RenewalIndex.build(
+    "output/1-renewals-index.sqlite", write(renewals, output, metrics)
+)
+metrics.finish()
 
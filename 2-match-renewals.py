@@ -9,33 +9,64 @@
 # Also eliminate from consideration renewals that do not correspond to
 # any registration in the dataset. (They're probably renewals for
 # some other piece of the dataset.)
-from pdb import set_trace
+#
+# Usage: python 2-match-renewals.py [number of processes]
+#
+# With more than one process, the registrations are split into shards
+# and matched in forked worker processes, which share a single copy of
+# the renewal data. The output is the same as with one process.
 from collections import defaultdict
-import json
+import codec
+import multiprocessing
+import os
+import shutil
+import sys
 import time
 from compare import Comparator
+from metrics import Metrics
 from model import Registration
 
 class Processor(object):
 
-    def __init__(self, comparator, output, cross_references):
+    def __init__(self, comparator, output=None, cross_references=None,
+                 metrics=None):
         self.comparator = comparator
         self.output = output
         self.cross_references = cross_references
+        self.metrics = metrics or Metrics()
 
     def process(self, registration):
-        renewals = self.comparator.renewal_for(registration)
+        """Find renewals for a registration and its children, and write
+        them all to self.output.
+        """
+        write = self.metrics.phase("write")
+        for annotated in self.annotate(registration):
+            with write:
+                codec.dump(
+                    annotated.jsonable(require_disposition=True), self.output
+                )
+
+    def annotate(self, registration):
+        """Find renewals for a registration, then for each of its
+        children.
+
+        :yield: Each registration as soon as its renewals have been
+            found, parent first. The caller must be done with each
+            registration before asking for the next one, because
+            processing the children adds warnings to the parent.
+        """
+        with self.metrics.phase("match"):
+            renewals = self.comparator.renewal_for(registration)
         registration.renewals = renewals
-        json.dump(registration.jsonable(require_disposition=True), self.output)
-        self.output.write("\n")
-        if registration.is_foreign:
-            # This looks like a foreign registration. We'll filter it out
-            # in the next step, but we need to record its cross-references
-            # now, so we can filter _those_ out in the next step.
-            for xref in registration.parse_xrefs():
-                out = self.cross_references
-                json.dump(xref.jsonable(), out)
-                out.write("\n")
+        yield registration
+
+        # Even if the cross-references aren't being written out, they
+        # need to be looked for, since that adds warnings to the
+        # parent, and the parent is included in each child.
+        xrefs = list(self.cross_references_for(registration))
+        if self.cross_references:
+            for xref in xrefs:
+                codec.dump(xref.jsonable(), self.cross_references)
 
         # Handle children as totally independent registrations. Note
         # that in the next step we may disquality children because the
@@ -44,34 +75,171 @@ class Processor(object):
         for child in registration.children:
             child = Registration(**child)
             child.parent = registration
-            self.process(child)
-
-annotated = open("output/2-registrations-with-renewals.ndjson", "w")
-cross_references = open("output/2-cross-references-in-foreign-registrations.ndjson", "w")
-
-comparator = Comparator("output/1-parsed-renewals.ndjson")
-processor = Processor(comparator, annotated, cross_references)
-before = time.time()
-count = 0
-for i in open("output/0-parsed-registrations.ndjson"):
-    processor.process(Registration(**json.loads(i)))
-    count += 1
-    if not count % 10000:
-        after = time.time()
-        print("%d %.2fsec" % (count, after-before))
-        before = after
-        after = None
-
-# Now that we're done, we can divide up the renewals by whether or not
-# we found a registration for them.
-
-renewals_matched = open("output/2-renewals-with-registrations.ndjson", "w")
-renewals_not_matched = open("output/2-renewals-with-no-registrations.ndjson", "w")
-for regnum, renewals in comparator.renewals.items():
-    for renewal in renewals:
-        if renewal in comparator.used_renewals:
-            out = renewals_matched
-        else:
-            out = renewals_not_matched
-        json.dump(renewal.jsonable(), out)
-        out.write("\n")
+            for annotated in self.annotate(child):
+                yield annotated
+
+    @classmethod
+    def cross_references_for(cls, registration):
+        if registration.is_foreign:
+            # This looks like a foreign registration. We'll filter it out
+            # in the next step, but we need to record its cross-references
+            # now, so we can filter _those_ out in the next step.
+            for xref in registration.parse_xrefs():
+                yield xref
+
+    @classmethod
+    def all_cross_references(cls, registration):
+        """Find the cross-references in a registration and its
+        children, without looking for renewals.
+
+        :yield: The same Registrations, in the same order, that
+            process() would write to self.cross_references.
+        """
+        for xref in cls.cross_references_for(registration):
+            yield xref
+        for child in registration.children:
+            for xref in cls.all_cross_references(Registration(**child)):
+                yield xref
+
+def shards(path, count):
+    """Divide a file into `count` pieces, each of which starts at the
+    beginning of a line.
+
+    Since each line of 0-parsed-registrations.ndjson holds a
+    registration along with all of its children, this never splits a
+    parent from its children.
+
+    :return: A list of (start, end) byte offsets.
+    """
+    size = os.stat(path).st_size
+    starts = [0]
+    with open(path, "rb") as f:
+        for i in range(1, count):
+            f.seek(size * i // count)
+            f.readline()
+            starts.append(max(f.tell(), starts[-1]))
+    ends = starts[1:] + [size]
+    return [(start, end) for start, end in zip(starts, ends) if start < end]
+
+# The Comparator a worker process matches shards against.
+worker_comparator = None
+
+def start_worker(comparator):
+    """Set up a worker process to match shards against `comparator`.
+
+    The workers are forked, so this doesn't copy the comparator; each
+    worker shares the main process's.
+    """
+    global worker_comparator
+    worker_comparator = comparator
+
+def match_shard(shard):
+    """Match the registrations in one shard of the input against
+    renewals.
+
+    This runs in a worker process set up by start_worker().
+
+    :return: The paths to the shard's annotated registrations and
+        cross-references, the positions of the renewals it used, and
+        the shard's metrics.
+    """
+    start, end = shard
+    comparator = worker_comparator
+    comparator.used_renewals = set()
+    annotated = "output/2-shard-%d-registrations.ndjson" % start
+    cross_references = "output/2-shard-%d-cross-references.ndjson" % start
+    metrics = Metrics(report_every=None)
+    parse = metrics.phase("parse")
+    with open(annotated, "w") as annotated_out, open(cross_references, "w") as cross_references_out:
+        processor = Processor(
+            comparator, annotated_out, cross_references_out, metrics
+        )
+        with open(INPUT, "rb") as f:
+            f.seek(start)
+            while f.tell() < end:
+                with parse:
+                    registration = Registration(**codec.loads(f.readline()))
+                processor.process(registration)
+                metrics.record()
+    return (
+        annotated, cross_references, comparator.used_renewal_positions(),
+        metrics.jsonable()
+    )
+
+def write_renewals(comparator, matched, not_matched):
+    """Divide up the renewals by whether or not we found a registration
+    for them.
+    """
+    for regnum, renewals in comparator.renewals.items():
+        for renewal in renewals:
+            if renewal in comparator.used_renewals:
+                out = matched
+            else:
+                out = not_matched
+            codec.dump(renewal.jsonable(), out)
+
+INPUT = "output/0-parsed-registrations.ndjson"
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    else:
+        processes = 1
+
+    annotated = open("output/2-registrations-with-renewals.ndjson", "w")
+    cross_references = open("output/2-cross-references-in-foreign-registrations.ndjson", "w")
+
+    comparator = Comparator(
+        "output/1-parsed-renewals.ndjson", "output/1-renewals-index.sqlite"
+    )
+    if processes > 1:
+        # The workers keep their own metrics, and the shard progress
+        # lines stand in for the usual ones.
+        metrics = Metrics("2-match-renewals", report_every=None)
+    else:
+        metrics = Metrics("2-match-renewals")
+    if processes > 1:
+        # Workers are forked so they share the comparator's data with
+        # this process rather than each loading a copy. A few shards
+        # per process keeps them all busy until the end.
+        pool = multiprocessing.get_context("fork").Pool(
+            processes, initializer=start_worker, initargs=(comparator,)
+        )
+        pieces = shards(INPUT, processes * 4)
+        for i, (annotated_shard, xref_shard, used, shard_metrics) in enumerate(
+            pool.imap(match_shard, pieces)
+        ):
+            # Put each shard's output in place as soon as it's
+            # ready, in the same order as the input.
+            for shard, out in (
+                (annotated_shard, annotated), (xref_shard, cross_references)
+            ):
+                with open(shard) as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(shard)
+            comparator.mark_used(used)
+            metrics.record(shard_metrics['records'])
+            metrics.merge(shard_metrics['phases'])
+            metrics.gauge("registrations per shard", shard_metrics['records'])
+            print("%d/%d shards %.2fsec" % (
+                i+1, len(pieces), time.time()-metrics.started
+            ))
+        pool.close()
+        pool.join()
+    else:
+        processor = Processor(comparator, annotated, cross_references, metrics)
+        parse = metrics.phase("parse")
+        for i in open(INPUT):
+            with parse:
+                registration = Registration(**codec.loads(i))
+            processor.process(registration)
+            metrics.record()
+
+    # Now that we're done, we can divide up the renewals by whether or not
+    # we found a registration for them.
+    write_renewals(
+        comparator,
+        open("output/2-renewals-with-registrations.ndjson", "w"),
+        open("output/2-renewals-with-no-registrations.ndjson", "w"),
+    )
+    metrics.finish()
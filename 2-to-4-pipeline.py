@@ -0,0 +1,85 @@
+# Run steps 2, 3 and 4 together, in a single pass.
+#
+# Usage: python 2-to-4-pipeline.py [--keep-intermediate]
+#
+# Each registration goes straight from 2-match-renewals.py's
+# Processor, to 3-filter.py's Processor, to its FINAL- file, without
+# being written out and read back in between steps. The FINAL- files
+# are the same as the ones you get by running the three scripts one
+# after another.
+#
+# The step 2 and step 3 files are only written if you ask for them
+# with --keep-intermediate.
+import importlib
+import sys
+import codec
+from compare import Comparator
+from metrics import Metrics
+from model import Registration
+
+match = importlib.import_module("2-match-renewals")
+classify = importlib.import_module("3-filter")
+sort = importlib.import_module("4-sort-it-out")
+
+keep_intermediate = "--keep-intermediate" in sys.argv[1:]
+metrics = Metrics("2-to-4-pipeline")
+
+def registrations():
+    parse = metrics.phase("parse")
+    for i in open("output/0-parsed-registrations.ndjson"):
+        with parse:
+            registration = Registration(**codec.loads(i))
+        yield registration
+
+# Step 3 needs to know about every registration that's mentioned in a
+# foreign registration, before it classifies anything. Finding them
+# all is much quicker than finding renewals, so do it up front.
+cross_references = []
+if keep_intermediate:
+    out = open("output/2-cross-references-in-foreign-registrations.ndjson", "w")
+# Only the cross-referencing itself is timed here; parsing the
+# registrations is timed as "parse", and shouldn't be counted twice.
+find_cross_references = metrics.phase("cross-references")
+for registration in registrations():
+    with find_cross_references:
+        for xref in match.Processor.all_cross_references(registration):
+            cross_references.append(xref)
+            if keep_intermediate:
+                codec.dump(xref.jsonable(), out)
+
+comparator = Comparator(
+    "output/1-parsed-renewals.ndjson", "output/1-renewals-index.sqlite"
+)
+matcher = match.Processor(comparator, metrics=metrics)
+classifier = classify.Processor(
+    cross_references, write=keep_intermediate, metrics=metrics
+)
+if keep_intermediate:
+    annotated_out = open("output/2-registrations-with-renewals.ndjson", "w")
+
+copy = metrics.phase("copy")
+write = metrics.phase("write")
+for registration in registrations():
+    for annotated in matcher.annotate(registration):
+        if keep_intermediate:
+            with write:
+                codec.dump(
+                    annotated.jsonable(require_disposition=True), annotated_out
+                )
+        # The next step gets its own copy of the registration, just as
+        # if it had read it from 2-registrations-with-renewals.ndjson.
+        with copy:
+            annotated = annotated.copy(require_disposition=True)
+        output = classifier.process(annotated)
+        with write:
+            sort.sort(output, annotated)
+    metrics.record()
+
+if keep_intermediate:
+    match.write_renewals(
+        comparator,
+        open("output/2-renewals-with-registrations.ndjson", "w"),
+        open("output/2-renewals-with-no-registrations.ndjson", "w"),
+    )
+sort.report()
+metrics.finish()
@@ -5,40 +5,66 @@
 #   found in those works. Those _other_ works may themselves have been
 #   published abroad -- we'll have to check on the next pass.
 
-from pdb import set_trace
 from collections import defaultdict
-import json
+import codec
 import datetime
 import re
 from collections import Counter
+from metrics import Metrics
 from model import Registration
-import time
-
-potentially_foreign = open("output/3-potentially-foreign-registrations.ndjson", "w")
 
 class Processor(object):
+    """Classify registrations, one at a time.
+
+    Registrations must arrive the way 2-match-renewals.py writes them:
+    each top-level registration immediately followed by its
+    children. That's all process() relies on, so any run of
+    registrations that starts with a top-level registration -- a
+    whole file, a shard of one, or a stream coming straight from the
+    previous step -- can be classified on its own.
+    """
 
     # Before this year, everything published in the US is public
     # domain.
     CUTOFF_YEAR = datetime.datetime.utcnow().year - 95
 
-    def __init__(self):
-        self.not_books_proper = open("output/3-registrations-not-books-proper.ndjson", "w")
-        self.foreign = open("output/3-registrations-foreign.ndjson", "w")
-        self.previously_published = open("output/3-registrations-previously-published.ndjson", "w")
-        self.too_old = open("output/3-registrations-too-early.ndjson", "w")
-        self.too_new = open("output/3-registrations-too-late.ndjson", "w")
-        self.in_range = open("output/3-registrations-in-range.ndjson", "w")
-        self.errors = open("output/3-registrations-error.ndjson", "w")
+    # The outputs of this step: the attribute that refers to each one,
+    # and the name of the file it's written to.
+    OUTPUTS = [
+        ("not_books_proper", "3-registrations-not-books-proper"),
+        ("foreign", "3-registrations-foreign"),
+        ("previously_published", "3-registrations-previously-published"),
+        ("too_old", "3-registrations-too-early"),
+        ("too_new", "3-registrations-too-late"),
+        ("in_range", "3-registrations-in-range"),
+        ("errors", "3-registrations-error"),
+    ]
+
+    def __init__(self, cross_references, write=True, metrics=None):
+        """
+        :param cross_references: The Registrations found in the
+            notes of foreign registrations during the previous step.
+
+        :param write: If this is False, nothing is written out;
+            process() just says which output each registration
+            belongs in.
+
+        :param metrics: A Metrics to time the classification with.
+        """
+        self.metrics = metrics or Metrics()
+        self.files = dict()
+        for attr, name in self.OUTPUTS:
+            setattr(self, attr, name)
+            if write:
+                self.files[name] = open("output/%s.ndjson" % name, "w")
         self.foreign_xrefs = defaultdict(list)
 
+        # The outputs chosen for the registrations in the current
+        # group -- the most recent top-level registration and its
+        # children.
         self.output_for_uuid = dict()
 
-        for i in open(
-            "output/2-cross-references-in-foreign-registrations.ndjson"
-        ):
-            data = json.loads(i)
-            reg = Registration(**data)
+        for reg in cross_references:
             for regnum in reg.regnums:
                 self.foreign_xrefs[regnum].append(reg)
         #self.cross_references_from_renewals = json.load(open(
@@ -93,9 +119,19 @@ class Processor(object):
         return self.in_range
 
 
-    def process(self, data):
-        registration = Registration.from_json(data)
-        output = self.disposition(registration)
+    def process(self, registration):
+        """Decide which output a registration belongs in, and write it
+        there.
+
+        :return: The name of the output.
+        """
+        with self.metrics.phase("classify"):
+            output = self.disposition(registration)
+        if not registration.parent:
+            # This registration starts a new group. Nothing from here
+            # on will refer back to the previous group, so it can be
+            # forgotten.
+            self.output_for_uuid = dict()
         if registration.uuid:
             self.output_for_uuid[registration.uuid] = output
 
@@ -103,8 +139,14 @@ class Processor(object):
             # In the previous step, children were processed
             # immediately after their parents. That means they're
             # processed after their parents here.
-
-            parent_output = self.output_for_uuid[registration.parent['uuid']]
+            parent_uuid = registration.parent['uuid']
+            if parent_uuid not in self.output_for_uuid:
+                raise Exception(
+                    "Registration %s came in without its parent %s immediately before it." % (
+                        registration.uuid, parent_uuid
+                    )
+                )
+            parent_output = self.output_for_uuid[parent_uuid]
             # In general, children are totally independent
             # registrations. However, if the 'parent' registration
             # (the one for which the most data is available) was
@@ -117,8 +159,13 @@ class Processor(object):
                 )
                 output = parent_output
 
-        json.dump(registration.jsonable(require_disposition=True), output)
-        output.write("\n")
+        if self.files:
+            with self.metrics.phase("write"):
+                codec.dump(
+                    registration.jsonable(require_disposition=True),
+                    self.files[output]
+                )
+        return output
 
 
     def error(self, registration, error):
@@ -126,15 +173,21 @@ class Processor(object):
         registration.error = error
         return self.errors
 
-processor = Processor()
-before = time.time()
-count = 0
-for i in open("output/2-registrations-with-renewals.ndjson"):
-    data = json.loads(i)
-    processor.process(data)
-    count += 1
-    if not count % 10000:
-        after = time.time()
-        print("%d %.2fsec" % (count, after-before))
-        before = after
-        after = None
+if __name__ == '__main__':
+    potentially_foreign = open("output/3-potentially-foreign-registrations.ndjson", "w")
+    cross_references = (
+        Registration(**codec.loads(i)) for i in open(
+            "output/2-cross-references-in-foreign-registrations.ndjson"
+        )
+    )
+    metrics = Metrics("3-filter")
+    processor = Processor(cross_references, metrics=metrics)
+    parse = metrics.phase("parse")
+    for i in open("output/2-registrations-with-renewals.ndjson"):
+        with parse:
+            registration = Registration.from_json(codec.loads(i))
+        processor.process(registration)
+        metrics.record()
+    for out in processor.files.values():
+        out.close()
+    metrics.finish()
@@ -1,6 +1,6 @@
 from model import Registration
-import json
-from pdb import set_trace
+import codec
+from metrics import Metrics
 
 
 class Output(object):
@@ -12,8 +12,7 @@ class Output(object):
         self.count = 0
 
     def output(self, i):
-        json.dump(i.jsonable(compact=self.COMPACT), self.out)
-        self.out.write("\n")
+        codec.dump(i.jsonable(compact=self.COMPACT), self.out)
         self.count += 1
 
     def tally(self, total):
@@ -75,30 +74,48 @@ all_outputs = [
     error,
 ]
 
-for file in (
-        "3-registrations-in-range",
-        "3-registrations-foreign",
-        "3-registrations-previously-published",
-        "3-registrations-too-late",
-        "3-registrations-too-early",
-        "3-registrations-not-books-proper",
-        "3-registrations-error",
-):
-    path = "output/%s.ndjson"
-    for i in open(path % file):
-            data = Registration.from_json(json.loads(i))
-            dest = destination(file, data.disposition)
-            dest.output(data)
+def sort(file, registration):
+    """Send a registration from one of the step 3 outputs to its final
+    destination.
+    """
+    dest = destination(file, registration.disposition)
+    dest.output(registration)
 
-in_range_total = sum(x.count for x in in_range_outputs)
-grand_total = sum(x.count for x in all_outputs)
+def report():
+    in_range_total = sum(x.count for x in in_range_outputs)
+    grand_total = sum(x.count for x in all_outputs)
 
-print("Among all publications:")
-for output in all_outputs:
-    print(output.tally(grand_total))
-print("Total: %s" % grand_total)
-print("")
-print("Among first US publications in renewal range:")
-for output in in_range_outputs:
-    print(output.tally(in_range_total))
-print("Total: %s" % in_range_total)
+    print("Among all publications:")
+    for output in all_outputs:
+        print(output.tally(grand_total))
+    print("Total: %s" % grand_total)
+    print("")
+    print("Among first US publications in renewal range:")
+    for output in in_range_outputs:
+        print(output.tally(in_range_total))
+    print("Total: %s" % in_range_total)
+
+if __name__ == '__main__':
+    metrics = Metrics("4-sort-it-out")
+    parse = metrics.phase("parse")
+    write = metrics.phase("write")
+    for file in (
+            "3-registrations-in-range",
+            "3-registrations-foreign",
+            "3-registrations-previously-published",
+            "3-registrations-too-late",
+            "3-registrations-too-early",
+            "3-registrations-not-books-proper",
+            "3-registrations-error",
+    ):
+        path = "output/%s.ndjson"
+        for i in open(path % file):
+                with parse:
+                    data = Registration.from_json(codec.loads(i))
+                with write:
+                    sort(file, data)
+                metrics.record()
+    report()
+    for output in all_outputs:
+        output.out.close()
+    metrics.finish()
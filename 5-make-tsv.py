@@ -1,20 +1,30 @@
-import json
-from pdb import set_trace
+import codec
+from metrics import Metrics
 from model import Registration, Renewal
 import unicodecsv 
 class Spreadsheet(object):
 
-    def __init__(self, output):
+    def __init__(self, output, metrics=None):
+        self.file = open(output, "wb")
         self.out = unicodecsv.writer(
-            open(output, "wb"), dialect="excel-tab",
+            self.file, dialect="excel-tab",
             encoding="utf-8"
         )
+        self.metrics = metrics or Metrics()
 
     def convert(self, input_file):
+        parse = self.metrics.phase("parse")
+        serialize = self.metrics.phase("serialize")
+        write = self.metrics.phase("write")
         self.out.writerow(Registration.csv_row_labels + Renewal.csv_row_labels)
         for line in open(input_file):
-            registration = Registration.from_json(json.loads(line))
-            self.out.writerow(registration.csv_row)
+            with parse:
+                registration = Registration.from_json(codec.loads(line))
+            with serialize:
+                row = registration.csv_row
+            with write:
+                self.out.writerow(row)
+            self.metrics.record()
 
 spreadsheets = {
     "renewed" : ["renewed", "probably-renewed", "possibly-renewed"],
@@ -23,9 +33,12 @@ spreadsheets = {
     "previously-published": ["previously-published"],
 }
 
+metrics = Metrics("5-make-tsv")
 for name, inputs in spreadsheets.items():
     output = "output/FINAL-%s.tsv" % name
-    spreadsheet = Spreadsheet(output)
+    spreadsheet = Spreadsheet(output, metrics)
     for i in inputs:
         filename = "output/FINAL-%s.ndjson" % i
         spreadsheet.convert(filename)
+    spreadsheet.file.close()
+metrics.finish()
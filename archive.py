@@ -0,0 +1,47 @@
+"""Talk to the Internet Archive's search API from several threads at
+once.
+
+This is written against internetarchive 5.x (see requirements.txt).
+"""
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+import internetarchive as ia
+
+
+class SharedSession(ia.session.ArchiveSession):
+    """An ArchiveSession that can be shared by several threads, and that
+    keeps its connections open between requests.
+
+    A plain ArchiveSession asks the server to close the connection
+    after every request, and every Search mounts a brand new
+    HTTPAdapter, with a brand new connection pool, on the session. With
+    several threads searching at once, they'd all be replacing
+    session.adapters out from under each other.
+    """
+
+    def __init__(self, host=None, connections=10):
+        """
+        :param host: Send requests to this URL (e.g.
+            "http://localhost:8000") instead of archive.org.
+        :param connections: How many connections to keep open, at most.
+            This should be at least the number of threads.
+        """
+        ia.session.ArchiveSession.__init__(self)
+        if host:
+            url = urlparse(host)
+            self.protocol = url.scheme + ":"
+            self.host = url.netloc
+        self.headers['Connection'] = 'keep-alive'
+
+        # One adapter, with room for every thread, mounted once and
+        # kept. It doesn't retry anything; the scripts retry failed
+        # searches themselves.
+        self.adapter = HTTPAdapter(pool_maxsize=connections, max_retries=0)
+        self.mount("%s//%s" % (self.protocol, self.host), self.adapter)
+
+    def mount_http_adapter(self, *args, **kwargs):
+        """Called by every Search (and by ArchiveSession.__init__) to
+        mount a new adapter. The adapter mounted in __init__ is kept
+        instead.
+        """
+        pass
@@ -0,0 +1,407 @@
+# Generate a synthetic copy of the input data, for benchmarking.
+#
+# Usage: python bench-0-generate-data.py [directory] [number of registrations] [--seed=N]
+#
+# The real inputs live in the `registrations` and `renewals`
+# submodules, which take a long time to fetch. This script writes data
+# that looks like them -- and like a Hathifile and the output of
+# ia-0-list-texts.py -- to `directory` (default "bench"), at whatever
+# scale you like (default 10000 registrations):
+#
+# * registrations/xml/[year]/[volume].xml - <copyrightEntry> tags, in
+#   volumes of VOLUME_SIZE entries.
+# * renewals/data/[year].tsv - Renewals, a fraction of which match
+#   a registration.
+# * hathifile.txt - Hathifile rows, some of which are scans of a
+#   registered book.
+# * output/ia-0-texts.ndjson - Internet Archive texts, likewise.
+#
+# The same arguments always produce the same data. Run the scripts
+# against it with bench-1-run.py.
+import codec
+import datetime
+import os
+import random
+import shutil
+import sys
+from xml.sax.saxutils import escape, quoteattr
+
+# The number of <copyrightEntry> tags in each XML volume.
+VOLUME_SIZE = 2000
+
+WORDS = """
+river house night garden stone winter letters history american journey
+secret island mountain silver children music city light shadow promise
+voyage empire kingdom western northern science principles modern
+practical chemistry physics elementary introduction handbook manual
+guide story tales poems mystery murder love valley road home farm
+ocean war peace spring summer autumn morning evening daughter son
+father mother doctor captain king queen horse dog lost golden last
+first new old great little red blue green dark bright wild quiet
+""".split()
+
+GENERIC_TITLES = [
+    "Annual report", "Poems", "Selected poems", "Collected works",
+    "Proceedings", "Catalog", "Bulletin", "Textbook of chemistry",
+]
+
+SURNAMES = """
+Smith Jones Brown Miller Davis Wilson Moore Taylor Anderson Thomas
+Jackson White Harris Martin Thompson Garcia Clark Lewis Robinson Walker
+O'Neil Muller McDonald Young Allen King Wright Scott Hill Green
+""".split()
+
+FORENAMES = """
+John Mary William Elizabeth James Margaret Robert Helen Charles Ruth
+George Dorothy Edward Alice Henry Frances Wm. A. B. J. R. Jean
+""".split()
+
+PUBLISHERS = [
+    "Macmillan", "Harper", "Doubleday", "Houghton Mifflin", "Scribner",
+    "Knopf", "Little, Brown", "Random House", "Viking Press",
+    "Dodd, Mead", "Rinehart", "Putnam", "Simon and Schuster",
+]
+
+DOMESTIC_PLACES = [
+    "New York", "Boston", "Chicago", "Philadelphia", "Garden City, N.Y.",
+    "Indianapolis", "San Francisco", "Los Angeles", "New York.",
+    "Boston, Mass.",
+]
+
+FOREIGN_PLACES = [
+    "London", "Paris", "Toronto, Canada", "Edinburgh, Scotland",
+    "Berlin", "Oxford, Eng.", "Sydney, Australia",
+]
+
+NOTES = [
+    "Prev. pub. in Harper's magazine.",
+    "Pub. abroad 1938.",
+    "Previously registered as an unpublished work.",
+    "Appeared serially.",
+    "AI-3456, 12Mar49.",
+    "American ed.",
+    "Illustrated.",
+    "Revised ed.",
+    "In part prev. pub.",
+]
+
+MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+
+# The columns of a renewals TSV file.
+RENEWAL_COLUMNS = [
+    "entry_id", "volume", "part", "number", "page", "auth", "titl",
+    "odat", "oreg", "id", "dreg", "claimants", "new_matter",
+    "see_also_ren", "see_also_reg", "full_text",
+]
+
+# The number of columns in a Hathifile row.
+HATHIFILE_COLUMNS = 26
+
+
+class Generator(object):
+
+    def __init__(self, directory, count, seed=0):
+        self.directory = directory
+        self.count = count
+        self.random = random.Random(seed)
+        self.uuids = 0
+
+        # The top-level registrations, as (regnum, date, title,
+        # authors) tuples, for the renewals and scans to refer to.
+        self.registrations = []
+
+    def path(self, *parts):
+        path = os.path.join(self.directory, *parts)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        return path
+
+    def uuid(self):
+        self.uuids += 1
+        return "%08X-%04X-0000-0000-%012X" % (
+            self.random.getrandbits(32), self.random.getrandbits(16),
+            self.uuids
+        )
+
+    def title(self):
+        r = self.random.random()
+        if r < 0.05:
+            return self.random.choice(GENERIC_TITLES)
+        title = " ".join(
+            self.random.choice(WORDS)
+            for i in range(self.random.randint(1, 7))
+        )
+        if r < 0.3:
+            title = "The " + title
+        return title.capitalize()
+
+    def author(self):
+        return "%s, %s" % (
+            self.random.choice(SURNAMES), self.random.choice(FORENAMES)
+        )
+
+    def typo(self, text):
+        """Change one letter of `text`, as a transcriber might."""
+        if len(text) < 4:
+            return text
+        i = self.random.randrange(len(text))
+        return text[:i] + self.random.choice("abcdefghij") + text[i+1:]
+
+    def date(self, year):
+        return datetime.date(
+            year, self.random.randint(1, 12), self.random.randint(1, 28)
+        )
+
+    def cce_date(self, date):
+        """Format a date as it appears in the text of the CCE: 5Mar50."""
+        return "%d%s%02d" % (date.day, MONTHS[date.month-1], date.year % 100)
+
+    def date_tag(self, name, date):
+        """A date tag, in one of the forms found in the CCE."""
+        r = self.random.random()
+        if r < 0.8:
+            return "<%s date=%s>%s</%s>" % (
+                name, quoteattr(date.isoformat()), self.cce_date(date), name
+            )
+        if r < 0.95:
+            return "<%s>%s</%s>" % (name, self.cce_date(date), name)
+        if r < 0.98:
+            return "<%s date=%s>%s</%s>" % (
+                name, quoteattr(date.isoformat()[:7]), self.cce_date(date),
+                name
+            )
+        # A date that can't be parsed.
+        return "<%s>%s</%s>" % (name, "-- %d" % date.day, name)
+
+    def regnum(self):
+        r = self.random.random()
+        if r < 0.9:
+            prefix = "A"
+        elif r < 0.95:
+            prefix = "AF"
+        elif r < 0.97:
+            prefix = "AI"
+        else:
+            prefix = self.random.choice(["B", "BB", "AA"])
+        return "%s%d" % (prefix, self.random.randint(1, 999999))
+
+    def entry(self, tag, year):
+        """Write out one registration as XML.
+
+        :return: A 2-tuple (xml, registration), where `registration`
+            is a tuple that can go into self.registrations.
+        """
+        regnum = self.regnum()
+        reg_date = self.date(year)
+        pub_date = reg_date - datetime.timedelta(
+            days=self.random.randint(0, 30)
+        )
+        title = self.title()
+        authors = [
+            self.author() for i in range(self.random.choice([0, 1, 1, 1, 2]))
+        ]
+        parts = ["<%s id=%s regnum=%s>" % (
+            tag, quoteattr(self.uuid()), quoteattr(regnum)
+        )]
+        for author in authors:
+            parts.append(
+                "<author><authorName>%s</authorName></author>" % escape(author)
+            )
+        parts.append("<title>%s.</title>" % escape(title))
+        if self.random.random() < 0.1:
+            parts.append("<edition>%d ed.</edition>" % self.random.randint(2, 5))
+        parts.append("<publisher>")
+        parts.append('<pubName claimant="yes">%s</pubName>' % escape(
+            self.random.choice(PUBLISHERS)
+        ))
+        if self.random.random() < 0.08:
+            place = self.random.choice(FOREIGN_PLACES)
+        else:
+            place = self.random.choice(DOMESTIC_PLACES)
+        parts.append("<pubPlace>%s</pubPlace>" % escape(place))
+        parts.append(self.date_tag("pubDate", pub_date))
+        parts.append("</publisher>")
+        parts.append(self.date_tag("regDate", reg_date))
+        if self.random.random() < 0.1:
+            parts.append("<note>%s</note>" % escape(self.random.choice(NOTES)))
+        if self.random.random() < 0.03:
+            parts.append("<prevPub>%s</prevPub>" % escape(
+                "%s, %s" % (self.random.choice(PUBLISHERS), year - 2)
+            ))
+        if self.random.random() < 0.02:
+            parts.append("<newMatterClaimed>%s</newMatterClaimed>" % escape(
+                self.random.choice(["introd.", "revisions", "illus."])
+            ))
+        if tag == "copyrightEntry" and self.random.random() < 0.05:
+            child, ignore = self.entry("additionalEntry", year)
+            parts.append(child)
+        parts.append("</%s>" % tag)
+        return "".join(parts), (regnum, reg_date, title, authors)
+
+    def write_registrations(self):
+        years = list(range(1923, 1978))
+        per_year = max(1, self.count // len(years))
+        written = 0
+        for year in years:
+            if written >= self.count:
+                break
+            if year == years[-1]:
+                todo = self.count - written
+            else:
+                todo = min(per_year, self.count - written)
+            for volume, start in enumerate(range(0, todo, VOLUME_SIZE)):
+                path = self.path(
+                    "registrations", "xml", str(year),
+                    "%d-v%03d.xml" % (year, volume)
+                )
+                with open(path, "w") as out:
+                    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                    out.write("<copyrightEntries>\n")
+                    for i in range(start, min(todo, start + VOLUME_SIZE)):
+                        xml, registration = self.entry("copyrightEntry", year)
+                        out.write(xml)
+                        out.write("\n")
+                        self.registrations.append(registration)
+                    out.write("</copyrightEntries>\n")
+            written += todo
+
+    def write_renewals(self):
+        """Renew about a fifth of the registrations, give or take some
+        mistakes, plus some registrations that aren't in the data.
+        """
+        by_year = {}
+        number = 0
+        for regnum, reg_date, title, authors in self.registrations:
+            r = self.random.random()
+            if r < 0.2:
+                pass
+            elif r < 0.22:
+                # A renewal for something that isn't in the data.
+                regnum = "A%d" % self.random.randint(1, 999999)
+                reg_date = self.date(reg_date.year)
+                title = self.title()
+                authors = [self.author()]
+            else:
+                continue
+            if self.random.random() < 0.1:
+                # The date didn't survive transcription.
+                reg_date = self.date(reg_date.year)
+            if authors and self.random.random() < 0.2:
+                authors = [self.author()]
+            if self.random.random() < 0.1:
+                title = self.typo(title)
+            number += 1
+            renewal_date = self.date(reg_date.year + 28)
+            author = "; ".join(authors)
+            by_year.setdefault(renewal_date.year, []).append(dict(
+                entry_id=self.uuid(), volume=str(renewal_date.year),
+                part="1", number=str(self.random.randint(1, 2)),
+                page=str(self.random.randint(1, 500)), auth=author,
+                titl=title, odat=reg_date.isoformat(), oreg=regnum,
+                id="R%d" % (100000 + number), dreg=renewal_date.isoformat(),
+                claimants=author, new_matter="",
+                see_also_ren="", see_also_reg="",
+                full_text="%s. %s. (c) %s; %s. R%d, %s; %s (A)" % (
+                    title.upper(), author, self.cce_date(reg_date), regnum,
+                    100000 + number, self.cce_date(renewal_date), author
+                ),
+            ))
+        for year, renewals in sorted(by_year.items()):
+            with open(self.path("renewals", "data", "%d.tsv" % year), "w") as out:
+                out.write("\t".join(RENEWAL_COLUMNS) + "\n")
+                for renewal in renewals:
+                    out.write(
+                        "\t".join(renewal[x] for x in RENEWAL_COLUMNS) + "\n"
+                    )
+
+    def scans(self, count):
+        """Make up `count` scanned books, about half of which are scans
+        of a registered book.
+
+        :yield: A (title, author, year) tuple for each one.
+        """
+        for i in range(count):
+            if self.registrations and self.random.random() < 0.5:
+                regnum, reg_date, title, authors = self.random.choice(
+                    self.registrations
+                )
+                year = reg_date.year + self.random.choice([0, 0, 0, 1, -1, 3])
+                if self.random.random() < 0.2:
+                    title = self.typo(title)
+                if authors and self.random.random() < 0.8:
+                    author = authors[0]
+                else:
+                    author = self.author()
+            else:
+                title = self.title()
+                author = self.author()
+                year = self.random.randint(1900, 1980)
+            yield title, author, year
+
+    def write_hathifile(self):
+        with open(self.path("hathifile.txt"), "w") as out:
+            for i, (title, author, year) in enumerate(
+                self.scans(self.count * 2)
+            ):
+                row = [""] * HATHIFILE_COLUMNS
+                row[0] = "mdp.%012d" % i
+                row[1] = "deny"
+                row[2] = self.random.choice(["ic", "ic", "ic", "und", "pd"])
+                row[3] = "%09d" % i
+                row[5] = "MIU"
+                row[11] = title + "."
+                row[12] = "%s, %d." % (self.random.choice(PUBLISHERS), year)
+                row[15] = "1" if self.random.random() < 0.02 else "0"
+                row[16] = str(year)
+                row[17] = "nyu"
+                row[18] = "eng"
+                row[19] = "BK" if self.random.random() < 0.95 else "SE"
+                row[25] = author
+                out.write("\t".join(row) + "\n")
+
+    def write_ia_texts(self):
+        with open(self.path("output", "ia-0-texts.ndjson"), "w") as out:
+            for i, (title, author, year) in enumerate(self.scans(self.count)):
+                data = dict(
+                    identifier="%s%05d" % (
+                        "".join(title.lower().split())[:16], i
+                    ),
+                    title=title, year=str(year), creator=author,
+                    publicdate="2015-01-01T00:00:00Z", mediatype="texts",
+                )
+                if self.random.random() < 0.02:
+                    data['licenseurl'] = (
+                        "http://creativecommons.org/licenses/by/4.0/"
+                    )
+                codec.dump(data, out)
+
+    def run(self):
+        self.write_registrations()
+        self.write_renewals()
+        self.write_hathifile()
+        self.write_ia_texts()
+
+
+if __name__ == '__main__':
+    seed = 0
+    arguments = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--seed="):
+            seed = int(arg[len("--seed="):])
+        else:
+            arguments.append(arg)
+    if arguments:
+        directory = arguments[0]
+    else:
+        directory = "bench"
+    if len(arguments) > 1:
+        count = int(arguments[1])
+    else:
+        count = 10000
+    for data in ("registrations", "renewals", "output"):
+        if os.path.exists(os.path.join(directory, data)):
+            shutil.rmtree(os.path.join(directory, data))
+    generator = Generator(directory, count, seed)
+    generator.run()
+    print("Wrote %d registrations to %s." % (len(generator.registrations), directory))
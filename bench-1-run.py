@@ -0,0 +1,206 @@
+# Time each script against the data written by bench-0-generate-data.py.
+#
+# Usage: python bench-1-run.py [directory] [--repo=DIR] [--processes=N] [--compare=COMMIT]
+#
+# Each script runs in its own process, in `directory` (default
+# "bench"), the same way you'd run it by hand. For each script this
+# records the wall-clock time, the number of records processed per
+# second, and the most memory the script's process used at any one
+# time. (Worker processes started by the script aren't counted.) The
+# phase timings each script writes to output/metrics/ are saved along
+# with them.
+#
+# The results are saved in `directory`/results/, named after the git
+# commit of the scripts being timed, so they can be compared against
+# a later run:
+#
+#   python bench-1-run.py bench --compare=3270046
+#
+# By default the scripts in this directory are timed. To time some
+# other version, check it out somewhere else (with `git worktree`, for
+# instance) and pass that directory as --repo.
+import codec
+import datetime
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Each script to time: a name, the arguments to run it with, and the
+# files whose lines count as the records it processed.
+STAGES = [
+    ("0-parse-registrations", ["0-parse-registrations.py", "{processes}"],
+     ["output/0-parsed-registrations.ndjson"]),
+    ("1-parse-renewals", ["1-parse-renewals.py"],
+     ["output/1-parsed-renewals.ndjson"]),
+    ("2-match-renewals", ["2-match-renewals.py", "{processes}"],
+     ["output/0-parsed-registrations.ndjson"]),
+    ("3-filter", ["3-filter.py"],
+     ["output/2-registrations-with-renewals.ndjson"]),
+    ("4-sort-it-out", ["4-sort-it-out.py"],
+     ["output/3-registrations-%s.ndjson" % x for x in (
+         "in-range", "foreign", "previously-published", "too-late",
+         "too-early", "not-books-proper", "error")]),
+    ("5-make-tsv", ["5-make-tsv.py"],
+     ["output/FINAL-%s.ndjson" % x for x in (
+         "renewed", "probably-renewed", "possibly-renewed", "not-renewed",
+         "foreign", "previously-published")]),
+    ("hathi-0-match-registrations",
+     ["hathi-0-match-registrations.py", "hathifile.txt", "{processes}"],
+     ["output/FINAL-not-renewed.ndjson"]),
+    ("ia-1-match-registrations", ["ia-1-match-registrations.py"],
+     ["output/FINAL-not-renewed.ndjson"]),
+]
+
+# Caches that would let a script skip most of its work. These are
+# removed before every run.
+CACHES = [
+    "output/0-parsed-registrations-cache",
+    "output/hathi-0-hathifile-cache.pickle",
+]
+
+
+def count_lines(directory, paths):
+    total = 0
+    for path in paths:
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                total += sum(1 for line in f)
+    return total
+
+
+def commit(repo):
+    """The commit the scripts in `repo` come from, marked if there are
+    uncommitted changes.
+    """
+    def git(*args):
+        return subprocess.run(
+            ["git"] + list(args), cwd=repo, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True
+        ).stdout.strip()
+    name = git("rev-parse", "--short", "HEAD") or "unknown"
+    if git("status", "--porcelain", "--untracked-files=no"):
+        name += "-dirty"
+    return name
+
+
+def run(directory, repo, name, arguments, processes):
+    """Run one script to completion.
+
+    :return: A dictionary of measurements.
+    """
+    arguments = [x.format(processes=processes) for x in arguments]
+    script = os.path.join(repo, arguments[0])
+    if not os.path.exists(os.path.join(directory, "logs")):
+        os.mkdir(os.path.join(directory, "logs"))
+    log = os.path.join(directory, "logs", name + ".log")
+    # The metrics file the script writes, if it writes one.
+    metrics = os.path.join(directory, "output", "metrics", name + ".json")
+    if os.path.exists(metrics):
+        os.remove(metrics)
+    with open(log, "w") as out:
+        before = time.time()
+        process = subprocess.Popen(
+            [sys.executable, script] + arguments[1:], cwd=directory,
+            stdout=out, stderr=subprocess.STDOUT
+        )
+        # os.wait4 reports the resources used by this process alone,
+        # which Popen.wait() doesn't.
+        pid, status, usage = os.wait4(process.pid, 0)
+        after = time.time()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise Exception(
+            "%s failed with status %d; see %s" % (
+                name, process.returncode, log
+            )
+        )
+    seconds = after - before
+    results = dict(
+        seconds=seconds,
+        cpu_seconds=usage.ru_utime + usage.ru_stime,
+        # On Linux, ru_maxrss is in kilobytes.
+        max_rss_mb=usage.ru_maxrss / 1024.0,
+    )
+    if os.path.exists(metrics):
+        with open(metrics) as f:
+            data = codec.loads(f.read())
+        results['phases'] = data['phases']
+        results['gauges'] = data['gauges']
+    return results
+
+
+def compare(results, baseline):
+    """Print the difference between two sets of results."""
+    print("")
+    print("Compared with %s:" % baseline['commit'])
+    old = dict((x['name'], x) for x in baseline['stages'])
+    for stage in results['stages']:
+        before = old.get(stage['name'])
+        if not before:
+            print("%-28s (not in %s)" % (stage['name'], baseline['commit']))
+            continue
+        print("%-28s %9.1f -> %9.1f records/sec (%+.1f%%), %7.1f -> %7.1f MB" % (
+            stage['name'], before['records_per_second'],
+            stage['records_per_second'],
+            (stage['records_per_second'] / (before['records_per_second'] or 1) - 1) * 100,
+            before['max_rss_mb'], stage['max_rss_mb'],
+        ))
+
+
+if __name__ == '__main__':
+    repo = HERE
+    processes = 1
+    baseline = None
+    arguments = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--repo="):
+            repo = os.path.abspath(arg[len("--repo="):])
+        elif arg.startswith("--processes="):
+            processes = int(arg[len("--processes="):])
+        elif arg.startswith("--compare="):
+            baseline = arg[len("--compare="):]
+        else:
+            arguments.append(arg)
+    if arguments:
+        directory = os.path.abspath(arguments[0])
+    else:
+        directory = os.path.abspath("bench")
+
+    for cache in CACHES:
+        path = os.path.join(directory, cache)
+        if os.path.isdir(path):
+            for i in os.listdir(path):
+                os.remove(os.path.join(path, i))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    results = dict(
+        commit=commit(repo), date=datetime.datetime.utcnow().isoformat(),
+        processes=processes, python=sys.version.split()[0], stages=[],
+    )
+    for name, script_arguments, counted in STAGES:
+        stage = run(directory, repo, name, script_arguments, processes)
+        stage['name'] = name
+        stage['records'] = count_lines(directory, counted)
+        stage['records_per_second'] = stage['records'] / (stage['seconds'] or 1)
+        results['stages'].append(stage)
+        print("%-28s %8d records %7.2fsec %9.1f records/sec %7.1f MB" % (
+            name, stage['records'], stage['seconds'],
+            stage['records_per_second'], stage['max_rss_mb']
+        ))
+
+    results_dir = os.path.join(directory, "results")
+    if not os.path.exists(results_dir):
+        os.mkdir(results_dir)
+    path = os.path.join(results_dir, results['commit'] + ".json")
+    with open(path, "w") as out:
+        codec.dump(results, out)
+    print("Results saved to %s" % path)
+
+    if baseline:
+        with open(os.path.join(results_dir, baseline + ".json")) as f:
+            compare(results, codec.loads(f.read()))
@@ -0,0 +1,48 @@
+"""Read and write the newline-delimited JSON files that carry data
+from one script to the next.
+
+Every script goes through this module rather than using the json
+module directly, so that the fastest available implementation is
+used everywhere:
+
+* Encoding always uses json.dumps, whose C encoder is several times
+  faster than json.dump (which only ever uses the pure-Python
+  encoder). The output is byte-for-byte what json.dump would write.
+  Faster encoders like orjson are deliberately not used, since they
+  produce different (though equivalent) output.
+
+* Decoding uses orjson if it's installed, and the json module
+  otherwise. The resulting objects are the same either way.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Encode `obj` as a single line of JSON."""
+    return json.dumps(obj)
+
+
+def dump(obj, out):
+    """Write `obj` to `out` as a single line of JSON, followed by a
+    newline.
+    """
+    out.write(json.dumps(obj))
+    out.write("\n")
+
+
+def loads(line):
+    """Decode a single line of JSON."""
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the json module about some
+            # things (NaN, very large integers, unpaired surrogates).
+            # Let the json module decide what to make of this line.
+            pass
+    return json.loads(line)
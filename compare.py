@@ -1,29 +1,237 @@
-from pdb import set_trace
 from collections import defaultdict
+import os
+import sqlite3
 from model import Registration, Renewal
-import json
+import codec
+
+class RenewalIndex(object):
+    """A prebuilt index of the renewals in 1-parsed-renewals.ndjson,
+    stored in an SQLite database by 1-parse-renewals.py.
+
+    Opening the index costs next to nothing: the database is
+    memory-mapped, and a renewal is only decoded the first time a
+    lookup finds it. This saves the work of loading and indexing
+    every renewal each time 2-match-renewals.py is run.
+    """
+
+    # How much of the database file SQLite may memory-map.
+    MMAP_SIZE = 2 ** 30
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._pid = None
+
+        # Each renewal is only turned into a Renewal object once, so
+        # that every lookup which finds a given renewal gets the same
+        # object back.
+        self._loaded = dict()
+        self._positions = dict()
+
+    @property
+    def db(self):
+        # An SQLite connection can't be shared with a forked worker
+        # process, so each process opens its own.
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect("file:%s?mode=ro" % self.path, uri=True)
+            self._db.execute("PRAGMA mmap_size=%d" % self.MMAP_SIZE)
+            self._pid = os.getpid()
+        return self._db
+
+    @classmethod
+    def build(cls, path, renewals):
+        """Write an index of `renewals` to `path`.
+
+        :param renewals: The Renewal objects, in the order they appear
+            in 1-parsed-renewals.ndjson.
+        """
+        partial = path + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        db = sqlite3.connect(partial)
+        db.execute(
+            "CREATE TABLE renewals (position INTEGER PRIMARY KEY, data TEXT)"
+        )
+        db.execute("CREATE TABLE keys (kind TEXT, key TEXT, position INTEGER)")
+        for position, renewal in enumerate(renewals):
+            db.execute(
+                "INSERT INTO renewals VALUES (?, ?)",
+                (position, codec.dumps(renewal.jsonable()))
+            )
+            db.executemany(
+                "INSERT INTO keys VALUES (?, ?, ?)",
+                [(kind, key, position) for kind, key in cls.keys(renewal)]
+            )
+        db.execute("CREATE INDEX keys_by_key ON keys (kind, key)")
+        db.commit()
+        db.close()
+        os.replace(partial, path)
+
+    @classmethod
+    def keys(cls, renewal):
+        """Every (kind, key) pair under which `renewal` can be looked up.
+
+        This must agree with the way Comparator indexes renewals in
+        memory.
+        """
+        for regnum in Comparator.regnum_keys(renewal):
+            yield "regnum", regnum
+        yield "title", Comparator.title_key(renewal)
+
+    def lookup(self, kind):
+        return RenewalLookup(self, kind)
+
+    def find(self, kind, key):
+        """Find all renewals with the given key, in the order they were
+        indexed.
+        """
+        return [
+            self._renewal(position, data) for position, data in self.db.execute(
+                "SELECT renewals.position, renewals.data FROM keys"
+                " JOIN renewals ON keys.position = renewals.position"
+                " WHERE keys.kind = ? AND keys.key IS ? ORDER BY keys.rowid",
+                (kind, key)
+            )
+        ]
+
+    def items(self, kind):
+        """Iterate over (key, [renewals]) for every key of the given kind,
+        in the order the keys were first seen.
+        """
+        by_key = dict()
+        for key, position, data in self.db.execute(
+            "SELECT keys.key, renewals.position, renewals.data FROM keys"
+            " JOIN renewals ON keys.position = renewals.position"
+            " WHERE keys.kind = ? ORDER BY keys.rowid",
+            (kind,)
+        ):
+            by_key.setdefault(key, []).append(self._renewal(position, data))
+        return by_key.items()
+
+    def at(self, position):
+        """Find the renewal at the given position in the index."""
+        if position in self._loaded:
+            return self._loaded[position]
+        [(data,)] = self.db.execute(
+            "SELECT data FROM renewals WHERE position = ?", (position,)
+        )
+        return self._renewal(position, data)
+
+    def position(self, renewal):
+        """Find the position in the index of a renewal returned by a
+        lookup.
+        """
+        return self._positions[renewal]
+
+    def _renewal(self, position, data):
+        renewal = self._loaded.get(position)
+        if renewal is None:
+            renewal = self._loaded[position] = Renewal(**codec.loads(data))
+            self._positions[renewal] = position
+        return renewal
+
+
+class RenewalLookup(object):
+    """Looks up renewals in a RenewalIndex by one kind of key.
+
+    This can stand in for the dictionaries Comparator builds when it
+    indexes renewals in memory.
+    """
+    def __init__(self, index, kind):
+        self.index = index
+        self.kind = kind
+
+    def __getitem__(self, key):
+        return self.index.find(self.kind, key)
+
+    def get(self, key, default=None):
+        return self[key] or default
+
+    def __contains__(self, key):
+        return len(self[key]) > 0
+
+    def items(self):
+        return self.index.items(self.kind)
+
 
 class Comparator(object):
-    def __init__(self, renewals_input_path):
+    def __init__(self, renewals_input_path, index_path=None):
+        """Index the renewals so that registrations can be matched
+        against them.
+
+        :param index_path: The path to an index written by
+            1-parse-renewals.py. If it's up to date, the renewals will be
+            looked up in the index instead of being loaded from
+            `renewals_input_path`.
+        """
+        self.used_renewals = set()
+        self.index = None
+        if index_path and os.path.exists(index_path) and (
+            os.stat(index_path).st_mtime
+            >= os.stat(renewals_input_path).st_mtime
+        ):
+            index = self.index = RenewalIndex(index_path)
+            self.renewals = index.lookup("regnum")
+            self.renewals_by_title = index.lookup("title")
+            # Renewal.renewal_key is never equal to a
+            # Registration.renewal_key, so there's nothing to index.
+            self.renewals_by_key = dict()
+            return
 
         self.renewals = defaultdict(list)
         self.renewals_by_title = defaultdict(list)
         self.renewals_by_key = defaultdict(list)
+
+        # Every renewal, in the order they appear in the input file,
+        # and the position of each one in that list.
+        self.all_renewals = []
+        self.positions = dict()
         
         for i in open(renewals_input_path):
-            renewal = Renewal(**json.loads(i))
-            regnum = renewal.regnum
-            if not regnum:
-                regnum = []
-            if not isinstance(regnum, list):
-                regnum = [regnum]
-            for r in regnum:
-                r = (r or "").replace("-", "")
+            renewal = Renewal(**codec.loads(i))
+            self.positions[renewal] = len(self.all_renewals)
+            self.all_renewals.append(renewal)
+            for r in self.regnum_keys(renewal):
                 self.renewals[r].append(renewal)
-            title = Registration._normalize_text(renewal.title) or renewal.title
-            self.renewals_by_title[title].append(renewal)
+            self.renewals_by_title[self.title_key(renewal)].append(renewal)
             self.renewals_by_key[renewal.renewal_key].append(renewal)
-        self.used_renewals = set()
+
+    def used_renewal_positions(self):
+        """The positions (within the input file) of every renewal in
+        self.used_renewals.
+
+        Unlike the Renewal objects themselves, these can be passed
+        between processes.
+        """
+        if self.index:
+            position = self.index.position
+        else:
+            position = self.positions.__getitem__
+        return sorted(position(renewal) for renewal in self.used_renewals)
+
+    def mark_used(self, positions):
+        """Add the renewals at the given positions to self.used_renewals."""
+        for position in positions:
+            if self.index:
+                renewal = self.index.at(position)
+            else:
+                renewal = self.all_renewals[position]
+            self.used_renewals.add(renewal)
+
+    @classmethod
+    def regnum_keys(cls, renewal):
+        """The registration numbers a renewal should be found under."""
+        regnum = renewal.regnum
+        if not regnum:
+            regnum = []
+        if not isinstance(regnum, list):
+            regnum = [regnum]
+        return [(r or "").replace("-", "") for r in regnum]
+
+    @classmethod
+    def title_key(cls, renewal):
+        """The title a renewal should be found under."""
+        return Registration._normalize_text(renewal.title) or renewal.title
        
     def renewal_for(self, registration):
         """Find a renewal for this registration.
@@ -34,8 +242,7 @@ class Comparator(object):
         renewal = None
         for regnum in registration.regnums:
             renum = regnum.replace("-", "")
-            if regnum in self.renewals:
-                renewals.extend(self.renewals[regnum])
+            renewals.extend(self.renewals.get(regnum, []))
         if renewals:
             renewals, disposition = self.best_renewal(registration, renewals)
             registration.disposition = disposition
@@ -49,7 +256,7 @@ class Comparator(object):
             #
             # n.b. right now there seem to be no such matches.
             key = registration.renewal_key
-            renewals_for_key = self.renewals_by_key[key]
+            renewals_for_key = self.renewals_by_key.get(key)
             if renewals_for_key:
                 renewals, disposition = self.best_renewal(registration, renewals_for_key)
                 registration.disposition = "Possibly renewed, based solely on title/author match."
@@ -58,7 +265,7 @@ class Comparator(object):
             # We'll count it as a tentative match if there has _ever_ been a renewal
             # for a book with a nearly-identical title.
             title = Registration._normalize_text(registration.title) or registration.title
-            renewals_for_title = self.renewals_by_title[title]
+            renewals_for_title = self.renewals_by_title.get(title)
             if renewals_for_title:
                 renewals, disposition = self.best_renewal(registration, renewals_for_title)
                 registration.disposition = "Possibly renewed, based solely on title match."
@@ -1,8 +1,7 @@
 import unicodecsv 
-from pdb import set_trace
 from model import Registration
 from collections import Counter
-import json
+import codec
 import sys
 if len(sys.argv) > 1:
     cutoff = float(sys.argv[1])
@@ -34,7 +33,7 @@ class Package(object):
 
 packages = []
 for i in open("output/hathi-0-matched.ndjson"):
-    data = json.loads(i)
+    data = codec.loads(i)
     quality = data['quality']
     if quality < cutoff:
         continue
@@ -0,0 +1,39 @@
+# Match unrenewed registrations against Hathi Trust metadata and the
+# Internet Archive texts found by ia-0-list-texts.py, in a single pass.
+#
+# This does the work of hathi-0-match-registrations.py and
+# ia-1-match-registrations.py, and writes the same output files, but
+# only has to read and normalize each registration once.
+#
+# Usage: python hathi-ia-match-registrations.py [Hathifile] [number of processes] [--token-index]
+#
+# The arguments mean the same thing as for
+# hathi-0-match-registrations.py.
+import sys
+from matching import HathiSource, IASource, Matcher, Normalizer, TokenIndex
+from metrics import Metrics
+
+if __name__ == '__main__':
+    metrics = Metrics("hathi-ia-match-registrations")
+    token_index = "--token-index" in sys.argv
+    arguments = [x for x in sys.argv[1:] if not x.startswith("--")]
+    if len(arguments) > 1:
+        processes = int(arguments[1])
+    else:
+        processes = 1
+
+    def index():
+        if token_index:
+            return TokenIndex()
+        return None
+
+    normalizer = Normalizer()
+    with metrics.phase("load"):
+        sources = [
+            HathiSource(normalizer, arguments[0], index(), processes),
+            IASource(normalizer, "output/ia-0-texts.ndjson", index()),
+        ]
+    matcher = Matcher(normalizer, sources, metrics)
+    matcher.run()
+    print(matcher.report())
+    metrics.finish()
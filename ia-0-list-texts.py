@@ -1,9 +1,33 @@
+# Download basic information about every text in the Internet
+# Archive from around the time of the registrations.
+#
+# Usage: python ia-0-list-texts.py [scan cutoff date] [--threads=N] [--host=URL]
+#
+# The date range is split into one shard per month, and the shards
+# are harvested in parallel by N threads (default 4). Each finished
+# shard is kept in SHARD_DIR until every shard is done, so an
+# interrupted run picks up where it left off when it's run again with
+# the same arguments, having lost at most one month per thread.
+#
+# With a scan cutoff date, only texts made public since that date are
+# downloaded, and they're merged into the existing ia-0-texts.ndjson
+# rather than replacing it.
+#
+# --host sends the searches somewhere other than archive.org, as with
+# ia-0-search.py.
 import datetime
-from pdb import set_trace
 from dateutil.parser import parse
-import json
+import codec
+import heapq
+import os
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import internetarchive as ia
+from archive import SharedSession
+
+OUTPUT = "output/ia-0-texts.ndjson"
+SHARD_DIR = "output/ia-0-texts"
 
 class IAClient(object):
 
@@ -27,7 +51,7 @@ class IAClient(object):
         if set_to:
             cls._session = set_to
         if not cls._session:
-            cls._session = ia.session.ArchiveSession()
+            cls._session = SharedSession()
         return cls._session
            
     @classmethod
@@ -50,25 +74,148 @@ class IAClient(object):
                     return
             yield i
 
-output = open("output/ia-0-texts.ndjson", "w")
-client = IAClient()
-
-# We may only want to get books that were scanned after a certain date.
-if len(sys.argv) > 1:
-    scan_cutoff_date = parse(sys.argv[1])
-else:
-    scan_cutoff_date = None
-
-# Get 10 years of texts on either side of the cutoff just to be safe.
-CUTOFF_YEAR = datetime.datetime.utcnow().year - 95 - 10
-START = "%s-01-01" % CUTOFF_YEAR
-FINISH = "1973-01-01"
-count = 0
-for i in client.search("date:[%s TO %s]" % (START, FINISH), scan_cutoff_date):
-    json.dump(i, output)
-    output.write("\n")
-    count += 1
-    # print(i.get("year"), i.get('title'), i.get("creator"))
-    if not count % 1000:
-        print(count)
-print("Total items: %d" % count)
+def shards(start, finish):
+    """Split the range of dates from `start` to `finish` (inclusive)
+    into one range per month.
+
+    :return: A list of (name, query) 2-tuples.
+    """
+    shards = []
+    year, month = int(start[:4]), int(start[5:7])
+    shard_start = start
+    while True:
+        year, month = year + month // 12, month % 12 + 1
+        shard_end = "%d-%02d-01" % (year, month)
+        if shard_end >= finish:
+            shards.append(
+                (shard_start, "date:[%s TO %s]" % (shard_start, finish))
+            )
+            return shards
+        # The end of each range but the last is exclusive, so no
+        # date is in two shards.
+        shards.append(
+            (shard_start, "date:[%s TO %s}" % (shard_start, shard_end))
+        )
+        shard_start = shard_end
+
+def shard_path(name, scan_cutoff_date):
+    if scan_cutoff_date:
+        name += "-since-" + scan_cutoff_date.strftime("%Y%m%d%H%M%S")
+    return os.path.join(SHARD_DIR, name + ".ndjson")
+
+def harvest(shard):
+    """Download every text in one shard, unless that was already done
+    in an earlier run.
+
+    This runs in a worker thread.
+
+    :return: The path to the shard's texts.
+    """
+    (name, query), scan_cutoff_date = shard
+    path = shard_path(name, scan_cutoff_date)
+    if os.path.exists(path):
+        print("%s: already done" % name)
+        return path
+    partial = path + ".partial"
+    count = 0
+    with open(partial, "w") as out:
+        for i in IAClient.search(query, scan_cutoff_date):
+            codec.dump(i, out)
+            count += 1
+    os.replace(partial, path)
+    print("%s: %d items" % (name, count))
+    return path
+
+def texts(path, skip=None):
+    """Read the texts in one file, in the order they were written.
+
+    :param skip: Leave out texts with these identifiers.
+    :yield: (publicdate, identifier, JSON line) 3-tuples.
+    """
+    for line in open(path):
+        data = codec.loads(line)
+        if skip and data['identifier'] in skip:
+            continue
+        yield data.get('publicdate') or '', data['identifier'], line
+
+def merge(paths, out, existing=None):
+    """Combine the texts from several shards (and, possibly, an earlier
+    run) into one file, most recently made public first.
+
+    Each shard is already in that order, as is the output of an
+    earlier run, so they're merged as they're read rather than being
+    loaded and sorted.
+
+    If a text shows up more than once, the first copy merged wins,
+    except that a copy from an earlier run always loses.
+
+    :return: The number of texts written.
+    """
+    streams = [texts(path) for path in paths]
+    if existing and os.path.exists(existing):
+        # Only the texts in this run's shards are worth remembering
+        # up front, and in an incremental run there aren't many.
+        replaced = set()
+        for path in paths:
+            for publicdate, identifier, line in texts(path):
+                replaced.add(identifier)
+        streams.append(texts(existing, replaced))
+    seen = set()
+    for publicdate, identifier, line in heapq.merge(
+        *streams, key=lambda x: x[0], reverse=True
+    ):
+        if identifier in seen:
+            continue
+        seen.add(identifier)
+        out.write(line)
+    return len(seen)
+
+if __name__ == '__main__':
+    client = IAClient()
+
+    arguments = [x for x in sys.argv[1:] if not x.startswith("--")]
+    threads = 4
+    host = None
+    for i in sys.argv[1:]:
+        if i.startswith("--threads="):
+            threads = int(i[len("--threads="):])
+        elif i.startswith("--host="):
+            host = i[len("--host="):]
+
+    # We may only want to get books that were scanned after a certain date.
+    if arguments:
+        scan_cutoff_date = parse(arguments[0])
+        if not scan_cutoff_date.tzinfo:
+            # Dates in the Internet Archive are in UTC.
+            scan_cutoff_date = scan_cutoff_date.replace(
+                tzinfo=datetime.timezone.utc
+            )
+    else:
+        scan_cutoff_date = None
+
+    # Get 10 years of texts on either side of the cutoff just to be safe.
+    CUTOFF_YEAR = datetime.datetime.utcnow().year - 95 - 10
+    START = "%s-01-01" % CUTOFF_YEAR
+    FINISH = "1973-01-01"
+
+    # The threads share one session, and with it one pool of
+    # connections.
+    IAClient.session(SharedSession(host, max(threads, 10)))
+
+    if not os.path.exists(SHARD_DIR):
+        os.makedirs(SHARD_DIR)
+    todo = [(x, scan_cutoff_date) for x in shards(START, FINISH)]
+    with ThreadPoolExecutor(threads) as pool:
+        paths = list(pool.map(harvest, todo))
+
+    # An incremental run adds to what's already been downloaded.
+    if scan_cutoff_date:
+        existing = OUTPUT
+    else:
+        existing = None
+    partial = OUTPUT + ".partial"
+    with open(partial, "w") as output:
+        count = merge(paths, output, existing)
+    os.replace(partial, OUTPUT)
+    shutil.rmtree(SHARD_DIR)
+    print("Total items: %d" % count)
@@ -1,44 +1,303 @@
+# Search the Internet Archive for books that might be scans of
+# registered works.
+#
+# Usage: python ia-0-search.py [number of threads] [requests per second] [--host=URL]
+#
+# With more than one thread, searches for several registrations are
+# run at once, but the output is written in the same order as with
+# one thread. The number of requests per second is limited if a limit
+# is given. --host sends the searches somewhere other than
+# archive.org, e.g. --host=http://localhost:8000 to try things out
+# against a local server.
+#
+# The results of every search are cached in SEARCH_CACHE for
+# SEARCH_CACHE_TTL, so a title that's already been searched for -- in
+# this run or an earlier one -- doesn't have to be searched for
+# again. Pass --no-cache to ignore the cache.
 import datetime
 from dateutil import parser as date_parser
-from pdb import set_trace
 import internetarchive as ia
-import os
 import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import codec
+from archive import SharedSession
+from metrics import Metrics
 from model import Registration
 
+SEARCH_CACHE = "output/ia-0-search-cache.sqlite"
+
+# How long a cached search is good for, in seconds.
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+
+# The most searches to keep in the cache. Once there are more, the
+# ones least recently used are removed.
+SEARCH_CACHE_SIZE = 1000000
+
+# How many cache hits to remember before noting in the database that
+# those searches were used.
+SEARCH_CACHE_USED_BATCH = 1000
+
+class SearchCache(object):
+    """The results of Internet Archive searches, stored in an SQLite
+    database.
+
+    Searches are keyed by the server they were sent to and the exact
+    query string sent to the API, along with the fields and sorts
+    asked for, so results from a test server never stand in for
+    results from archive.org.
+    """
+
+    def __init__(self, path, ttl=SEARCH_CACHE_TTL, size=SEARCH_CACHE_SIZE,
+                 used_batch=SEARCH_CACHE_USED_BATCH):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        # When each search found in the cache was used, kept here
+        # until there are enough of them to be worth writing out.
+        self.used = dict()
+        self.used_batch = used_batch
+
+        # The connection is shared by all the search threads, one at
+        # a time.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS searches "
+            "(key TEXT PRIMARY KEY, results TEXT, created REAL, used REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS searches_used ON searches (used)"
+        )
+        self.db.commit()
+
+        # The number of searches in the cache, or a little more if
+        # some searches have been replaced. It's only counted properly
+        # when it looks like there might be too many.
+        self.count = self.db.execute(
+            "SELECT COUNT(*) FROM searches"
+        ).fetchone()[0]
+
+    @classmethod
+    def key(cls, server, query, fields, sorts, params):
+        return json.dumps([server, query, fields, sorts, params], sort_keys=True)
+
+    def get(self, key):
+        """Find the cached results of a search.
+
+        :return: A list of results, or None if the search isn't
+            cached or the cached results are too old.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT results FROM searches WHERE key=? AND created>=?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used[key] = now
+            if len(self.used) >= self.used_batch:
+                self.write_used()
+                self.db.commit()
+        return codec.loads(row[0])
+
+    def write_used(self):
+        """Note when the searches found in the cache were used, so the
+        ones used least recently can be removed first.
+
+        The caller must hold self.lock, and commit.
+        """
+        if not self.used:
+            return
+        self.db.executemany(
+            "UPDATE searches SET used=? WHERE key=?",
+            [(used, key) for key, used in self.used.items()]
+        )
+        self.used.clear()
+
+    def put(self, key, results):
+        """Cache the results of a search."""
+        now = time.time()
+        with self.lock:
+            # Bring the records of use up to date before anything
+            # might be removed.
+            self.write_used()
+            self.db.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)",
+                (key, codec.dumps(results), now, now)
+            )
+            self.count += 1
+            if self.count > self.size:
+                self.count = self.db.execute(
+                    "SELECT COUNT(*) FROM searches"
+                ).fetchone()[0]
+            if self.count > self.size:
+                # Make some room, removing expired searches first.
+                self.db.execute(
+                    "DELETE FROM searches WHERE key IN (SELECT key FROM searches "
+                    "ORDER BY created >= ?, used LIMIT ?)",
+                    (now - self.ttl, self.count - self.size + self.size // 10)
+                )
+                self.count = self.db.execute(
+                    "SELECT COUNT(*) FROM searches"
+                ).fetchone()[0]
+            self.db.commit()
+
+    def report(self):
+        return "Search cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def close(self):
+        with self.lock:
+            self.write_used()
+            self.db.commit()
+        self.db.close()
+
+class RateLimiter(object):
+    """A token bucket, shared by all the threads making requests."""
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Requests per second.
+        :param burst: How many requests can be made at once after a
+            quiet period. Defaults to one second's worth.
+        """
+        self.rate = float(rate)
+        self.capacity = burst or max(1, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Wait until a request can be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
 class IAClient(object):
 
     FIELDS = ["identifier", "date", "year", "creator", "language", "title", "licenseurl", "call_number", "createddate", "imagecount", "stars", "avg_rating", "creatorSorter", "titleSorter", "publicdate"]
 
+    # A search that fails is tried this many more times, waiting
+    # BACKOFF seconds before the first retry and twice as long before
+    # each retry after that.
+    RETRIES = 3
+    BACKOFF = 1
+
     _session = None
+    _rate_limiter = None
+    _cache = None
     
-    def __init__(self, output_file):
+    def __init__(self, output_file, threads=1, rate=None, cache=None,
+                 metrics=None):
+        """
+        :param threads: How many searches to run at once.
+        :param rate: The most searches to start per second, or None
+            for no limit.
+        :param cache: A SearchCache, or None to always ask the API.
+        :param metrics: A Metrics to keep track of the searches with.
+        """
+        self.metrics = metrics or Metrics()
         self.done = set()
         if os.path.exists(output_file):
             for i in open(output_file):
-                data = json.loads(i)
+                data = codec.loads(i)
                 self.done.add(data['uuid'])
         self.out = open(output_file, "a")
-                
-    def process(self, input_file):
+        self.threads = threads
+        if rate:
+            IAClient._rate_limiter = RateLimiter(rate)
+        IAClient._cache = cache
+
+    def registrations(self, input_file):
         for i in open(input_file):
-            data = json.loads(i)
+            data = codec.loads(i)
             disposition = data['disposition']
             if disposition.startswith('Renewed'):
                 continue
-            self.process_data(data)
-            json.dump(data, self.out)
-            self.out.write("\n")
+            yield data
+                
+    def process(self, input_file):
+        if self.threads > 1:
+            return self.process_concurrently(input_file)
+        search = self.metrics.phase("search")
+        write = self.metrics.phase("write")
+        for data in self.registrations(input_file):
+            with search:
+                self.process_data(data)
+            with write:
+                codec.dump(data, self.out)
+            self.metrics.record()
+
+    def process_concurrently(self, input_file):
+        """Like process(), but search for several registrations at
+        once.
+
+        Each registration's searches are run in a worker thread. The
+        registrations are written out (and their progress messages
+        printed) in the order they were read, so the output is the
+        same as process() would write.
+        """
+        # Keep a few registrations queued up for each thread, so one
+        # slow registration doesn't leave the others with nothing to
+        # do.
+        window = self.threads * 4
+        pending = deque()
+        with ThreadPoolExecutor(self.threads) as pool:
+            for data in self.registrations(input_file):
+                pending.append(pool.submit(self.process_quietly, data))
+                self.metrics.gauge("pending registrations", len(pending))
+                if len(pending) >= window:
+                    self.finish(pending.popleft())
+            while pending:
+                self.finish(pending.popleft())
+
+    def process_quietly(self, data):
+        """Run process_data, keeping track of the progress messages
+        instead of printing them.
+        """
+        messages = []
+        self.process_data(data, messages.append)
+        return data, messages
+
+    def finish(self, future):
+        with self.metrics.phase("wait"):
+            data, messages = future.result()
+        for message in messages:
+            print(message)
+        with self.metrics.phase("write"):
+            codec.dump(data, self.out)
+        self.metrics.record()
             
-    def process_data(self, data):
+    def process_data(self, data, log=print):
             uuid = data['uuid']
             if uuid in self.done:
                 return
             title, authors = data['title'], data['authors']
             if not title:
                 return
+            # Dates that couldn't be parsed have no normalized form.
             reg_dates = [
                 date_parser.parse(x['_normalized']) for x in data['reg_dates']
+                if x.get('_normalized')
             ]
             reg_dates = reg_dates or [None]
             #title = Registration._normalize_text(title)            
@@ -49,7 +308,7 @@ class IAClient(object):
             # quick and most of the time they return nothing.
             query, results = self.search(title, None)
             search_data[query] = results
-            print ("%s: %s" % (query, len(results)))
+            log("%s: %s" % (query, len(results)))
             
             # If we got results, try to zoom in by searching within 10 years of
             # the registration date.            
@@ -57,7 +316,7 @@ class IAClient(object):
                 for reg_date in reg_dates:
                     query, results = self.search(title, reg_date)
                     search_data[query] = results
-                    print ("%s: %s" % (query, len(results)))
+                    log("%s: %s" % (query, len(results)))
                 
     def search(self, title, date):
         query = self.query(title, date)
@@ -75,7 +334,7 @@ class IAClient(object):
         if set_to:
             cls._session = set_to
         if not cls._session:
-            cls._session = ia.session.ArchiveSession()
+            cls._session = SharedSession()
         return cls._session
 
     @classmethod
@@ -95,17 +354,80 @@ class IAClient(object):
         fields = cls.FIELDS
         sorts = ["date asc"]
         query = query + " and mediatype:texts"
-        search = ia.search.Search(
-            cls.session(), query, *args, fields=fields, sorts=sorts,
-            params=dict(count=100, page=1),
-            **kwargs
-        )
-        try:
-            for i in search.iter_as_results():
-                yield i
-        except Exception as e:
-            print(e)
-            return
-                
-client = IAClient("output/ia-0-searches.ndjson")
-client.process("output/3-registrations-in-range.ndjson")
+        params = dict(count=100, page=1)
+        cache = None
+        if cls._cache and not args and not kwargs:
+            cache = cls._cache
+            session = cls.session()
+            key = cls._cache.key(
+                session.protocol + "//" + session.host, query, fields,
+                sorts, params
+            )
+            results = cache.get(key)
+            if results is not None:
+                for i in results:
+                    yield i
+                return
+
+        for attempt in range(cls.RETRIES + 1):
+            if cls._rate_limiter:
+                cls._rate_limiter.wait()
+            search = ia.search.Search(
+                cls.session(), query, *args, fields=fields, sorts=sorts,
+                params=dict(params),
+                **kwargs
+            )
+            results = []
+            try:
+                for i in search.iter_as_results():
+                    results.append(i)
+            except Exception as e:
+                failure = e
+            else:
+                # An error from the API comes through as a result,
+                # not an exception.
+                failure = next(
+                    (x['error'] for x in results if 'error' in x), None
+                )
+            if failure is None:
+                # The search worked; remember it.
+                if cache:
+                    cache.put(key, results)
+                break
+            if attempt == cls.RETRIES:
+                print(failure)
+                break
+            time.sleep(cls.BACKOFF * 2 ** attempt)
+        for i in results:
+            yield i
+
+if __name__ == '__main__':
+    arguments = [x for x in sys.argv[1:] if not x.startswith("--")]
+    if len(arguments) > 0:
+        threads = int(arguments[0])
+    else:
+        threads = 1
+    if len(arguments) > 1:
+        rate = float(arguments[1])
+    else:
+        rate = None
+    host = None
+    for i in sys.argv[1:]:
+        if i.startswith("--host="):
+            host = i[len("--host="):]
+    IAClient.session(SharedSession(host, max(threads, 10)))
+    if "--no-cache" in sys.argv:
+        cache = None
+    else:
+        cache = SearchCache(SEARCH_CACHE)
+
+    metrics = Metrics("ia-0-search")
+    client = IAClient(
+        "output/ia-0-searches.ndjson", threads, rate, cache, metrics
+    )
+    client.process("output/3-registrations-in-range.ndjson")
+    client.out.close()
+    metrics.finish()
+    if cache:
+        print(cache.report())
+        cache.close()
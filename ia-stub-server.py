@@ -0,0 +1,231 @@
+# Pretend to be the Internet Archive's search API, so ia-0-search.py
+# and ia-0-list-texts.py can be tried out without touching archive.org.
+#
+# Usage: python ia-stub-server.py [directory] [port] [--fail=RATE] [--error=RATE]
+#
+# The texts in `directory`/output/ia-0-texts.ndjson (default "bench",
+# as written by bench-0-generate-data.py) are served on `port`
+# (default 8000), through both the advanced search API used by
+# ia-0-search.py and the scrape API used by ia-0-list-texts.py. Point
+# the scripts at it with --host:
+#
+#   python ia-stub-server.py bench 8000 --fail=0.1
+#   python ia-0-search.py 8 --host=http://localhost:8000 --no-cache
+#
+# --fail=0.1 makes one request in ten fail with an HTTP error, and
+# --error=0.1 makes one in ten return an error inside an otherwise
+# successful response, the way the real API sometimes does. The
+# scripts are expected to retry both.
+#
+# Only the parts of the query language the scripts use are understood:
+# title:("...") and date:[... TO ...]. Everything else is ignored.
+#
+# Stop the server with Ctrl-C (or kill it) to see how many requests it served, how
+# many it failed on purpose, and how many connections they came in on.
+import codec
+import json
+import os
+import random
+import re
+import signal
+import sys
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TITLE = re.compile(r'title:\("([^"]*)"\)')
+DATE = re.compile(r'date:\[(\S+) TO (\S+?)([\]}])')
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class Archive(object):
+    """The texts being served, and the statistics on serving them."""
+
+    def __init__(self, path, fail=0, error=0):
+        self.texts = [codec.loads(line) for line in open(path)]
+        self.dates = [self.date(x) for x in self.texts]
+        # Which texts have each word in their titles.
+        self.titles = defaultdict(set)
+        for position, text in enumerate(self.texts):
+            for word in WORD.findall((text.get('title') or '').lower()):
+                self.titles[word].add(position)
+        self.fail = fail
+        self.error = error
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.errors = 0
+        self.connections = set()
+
+    @classmethod
+    def date(cls, text):
+        date = (text.get('date') or text.get('year') or '')[:10]
+        if len(date) == 4:
+            date += "-01-01"
+        return date
+
+    def search(self, query, sorts):
+        """Find the texts that match a query.
+
+        :param sorts: A list of strings like "date asc".
+        """
+        positions = range(len(self.texts))
+        title = TITLE.search(query)
+        if title:
+            found = [
+                self.titles.get(word, set())
+                for word in WORD.findall(title.group(1).lower())
+            ]
+            if found:
+                positions = set.intersection(*found)
+        date = DATE.search(query)
+        if date:
+            start, finish, inclusive = date.groups()
+            positions = [
+                x for x in positions
+                if start <= self.dates[x] and (
+                    self.dates[x] <= finish if inclusive == "]"
+                    else self.dates[x] < finish
+                )
+            ]
+        texts = [self.texts[x] for x in sorted(positions)]
+        for sort in reversed(sorts):
+            field, direction = (sort.split() + ["asc"])[:2]
+            if field == "date":
+                key = self.date
+            else:
+                key = lambda x: x.get(field) or ''
+            texts = sorted(texts, key=key, reverse=(direction == "desc"))
+        return texts
+
+    def misbehave(self, client):
+        """Decide whether to fail this request on purpose.
+
+        :return: "fail", "error", or None to behave.
+        """
+        with self.lock:
+            self.requests += 1
+            self.connections.add(client)
+            roll = self.random.random()
+            if roll < self.fail:
+                self.failures += 1
+                return "fail"
+            if roll < self.fail + self.error:
+                self.errors += 1
+                return "error"
+        return None
+
+    def report(self):
+        return "%d requests, %d failed, %d errors, %d connections" % (
+            self.requests, self.failures, self.errors, len(self.connections)
+        )
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    # Keep connections open between requests, like the real API.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        misbehave = archive.misbehave(self.client_address)
+        if misbehave == "fail":
+            return self.respond(503, "Service unavailable")
+        if misbehave == "error":
+            return self.respond(200, {"error": "The search failed."})
+        if url.path.endswith("/advancedsearch.php"):
+            self.advanced_search(params)
+        elif url.path.endswith("/services/search/v1/scrape"):
+            self.scrape(params)
+        else:
+            self.respond(404, {"error": "Not found"})
+
+    do_POST = do_GET
+
+    def advanced_search(self, params):
+        sorts = [v for k, v in sorted(params.items()) if k.startswith("sort[")]
+        fields = [v for k, v in sorted(params.items()) if k.startswith("fl[")]
+        texts = archive.search(params.get('q', ''), sorts)
+        rows = int(params.get('rows') or params.get('count') or 50)
+        page = int(params.get('page') or 1)
+        docs = [
+            self.fields(x, fields)
+            for x in texts[(page - 1) * rows:page * rows]
+        ]
+        self.respond(
+            200, dict(response=dict(numFound=len(texts), start=(page - 1) * rows, docs=docs))
+        )
+
+    def scrape(self, params):
+        sorts = [x for x in params.get('sorts', '').split(",") if x]
+        fields = [x for x in params.get('fields', '').split(",") if x]
+        texts = archive.search(params.get('q', ''), sorts)
+        count = int(params.get('count') or 100)
+        cursor = int(params.get('cursor') or 0)
+        data = dict(
+            items=[self.fields(x, fields) for x in texts[cursor:cursor + count]],
+            count=len(texts[cursor:cursor + count]), total=len(texts),
+        )
+        if cursor + count < len(texts):
+            data['cursor'] = str(cursor + count)
+        self.respond(200, data)
+
+    @classmethod
+    def fields(cls, text, fields):
+        if not fields:
+            return text
+        return dict((k, v) for k, v in text.items() if k in fields)
+
+    def respond(self, status, data):
+        """Send a response: JSON, or an error page if `data` is a
+        string.
+        """
+        if isinstance(data, str):
+            body = data.encode("utf8")
+            content_type = "text/plain"
+        else:
+            body = json.dumps(data).encode("utf8")
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            # The client asked for the connection to be closed after
+            # this request. Say that it will be, or the client may
+            # try to use it again.
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+    fail = error = 0
+    arguments = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--fail="):
+            fail = float(arg[len("--fail="):])
+        elif arg.startswith("--error="):
+            error = float(arg[len("--error="):])
+        else:
+            arguments.append(arg)
+    directory = arguments[0] if arguments else "bench"
+    port = int(arguments[1]) if len(arguments) > 1 else 8000
+
+    archive = Archive(
+        os.path.join(directory, "output", "ia-0-texts.ndjson"), fail, error
+    )
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    print("Serving %d texts on http://localhost:%d" % (len(archive.texts), port))
+    # Being killed is as good as Ctrl-C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(archive.report())
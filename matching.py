@@ -0,0 +1,1155 @@
+"""Code shared by the scripts that match registrations against scanned
+books (the hathi-* and ia-* scripts).
+
+A Matcher reads the unrenewed registrations once and scores each one
+against any number of Sources of scanned books -- currently the
+Hathifile (HathiSource) and the Internet Archive texts downloaded by
+ia-0-list-texts.py (IASource).
+"""
+import datetime
+import gc
+import gzip
+import hashlib
+import math
+import os
+import pickle
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from multiprocessing import Pool
+import Levenshtein as lev
+import codec
+from metrics import Metrics
+from model import Registration
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from rapidfuzz import process as rapidfuzz_process
+    from rapidfuzz.distance import Levenshtein as rapidfuzz_levenshtein
+except ImportError:
+    rapidfuzz_process = None
+
+# Ignore CCE entries if they have more than this many matches in a
+# source.
+MATCH_CUTOFF = 50
+
+# Only output potential matches if the quality score is above this level.
+QUALITY_CUTOFF = 0
+
+# Stuff published before this year is public domain.
+CUTOFF_YEAR = datetime.datetime.today().year - 95
+
+# The most normalized titles, and normalized names, to remember at
+# once. Once a cache is full, the least recently used entries are
+# forgotten.
+TITLE_CACHE_SIZE = 1000000
+NAME_CACHE_SIZE = 250000
+
+
+class CandidateSizes(object):
+    """Keeps track of how many candidates were found for each title,
+    whichever way they were found.
+    """
+
+    def __init__(self):
+        self.sizes = []
+        self.truncated = 0
+        self.respelled = 0
+
+    def add(self, size, truncated=False):
+        self.sizes.append(size)
+        if truncated:
+            self.truncated += 1
+
+    def report(self):
+        """Summarize the sizes of the candidate sets."""
+        sizes = sorted(self.sizes)
+        if not sizes:
+            return "No titles looked up."
+
+        def percentile(p):
+            return sizes[min(len(sizes)-1, int(len(sizes) * p))]
+
+        lines = [
+            "Candidate sets for %d titles:" % len(sizes),
+            " Empty: %d" % sizes.count(0),
+            " Mean size: %.1f" % (sum(sizes) / float(len(sizes))),
+            " Median: %d  90th percentile: %d  99th percentile: %d  Max: %d" % (
+                percentile(0.5), percentile(0.9), percentile(0.99), sizes[-1]
+            ),
+            " Truncated: %d" % self.truncated,
+            " Total pairs to score: %d" % sum(sizes),
+        ]
+        if self.respelled:
+            lines.append(
+                " Unknown words spelled like words in the index: %d"
+                % self.respelled
+            )
+        return "\n".join(lines)
+
+
+class TokenIndex(object):
+    """An inverted index from the words in a title to the items with
+    that word in their title.
+
+    This is an alternative to blocking on Normalizer.title_key (the two
+    longest words in the title). With title_key, a typo or a changed
+    word in either of those two words means the right match is never
+    even considered, and a common pair of words can put thousands of
+    items in one block. Here, a candidate only needs to share some
+    proportion of a title's useful words, and the number of candidates
+    is capped.
+
+    A title's useful words are the ones found in the index that aren't
+    too common. A word that isn't in the index at all -- an OCR error,
+    say -- stands for the words in the index that are spelled almost
+    the same way, which are found by the three-letter sequences they
+    have in common. (Only the index's vocabulary is broken up this
+    way, not every title, so this takes little memory.)
+
+    The tradeoff between recall and the number of candidates that
+    need to be scored is controlled by these settings:
+
+    * min_shared: The proportion of a title's useful words that a
+      candidate must share with it.
+    * max_postings: Words found in more titles than this are too
+      common to be useful and are ignored (unless a title has nothing
+      else).
+    * max_candidates: The most candidates returned for any one title.
+      Shared words are weighted by how rare they are, and the
+      candidates whose shared words weigh the most are kept. Any
+      candidates that are still tied go in the order they were added.
+    * min_similarity: How much of its spelling (as a Dice coefficient
+      of three-letter sequences) a word in the index must share with
+      an unknown word to stand in for it.
+    * max_similar: The most words in the index that can stand in for
+      any one unknown word.
+    """
+
+    # The most unknown words to remember the stand-ins for.
+    SIMILAR_CACHE_SIZE = 100000
+
+    def __init__(self, min_shared=0.5, max_postings=5000, max_candidates=250,
+                 min_similarity=0.5, max_similar=3):
+        self.min_shared = min_shared
+        self.max_postings = max_postings
+        self.max_candidates = max_candidates
+        self.min_similarity = min_similarity
+        self.max_similar = max_similar
+        self.items = []
+        self.postings = defaultdict(list)
+        # The words in the index with each three-letter sequence, and
+        # the number of different sequences in each word.
+        self.trigrams = defaultdict(list)
+        self.trigram_counts = dict()
+        self.similar_words = lru_cache(maxsize=self.SIMILAR_CACHE_SIZE)(
+            self._similar_words
+        )
+        self.sizes = CandidateSizes()
+
+    @classmethod
+    def words(cls, normalized_title):
+        return set(x for x in normalized_title.split(" ") if x)
+
+    @classmethod
+    def word_trigrams(cls, word):
+        padded = " %s " % word
+        return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+    def add(self, normalized_title, item):
+        position = len(self.items)
+        self.items.append(item)
+        for word in self.words(normalized_title):
+            if word not in self.postings:
+                trigrams = self.word_trigrams(word)
+                for trigram in trigrams:
+                    self.trigrams[trigram].append(word)
+                self.trigram_counts[word] = len(trigrams)
+                # The vocabulary has changed.
+                self.similar_words.cache_clear()
+            self.postings[word].append(position)
+
+    def _similar_words(self, word):
+        """Find the words in the index that are spelled almost like
+        `word`, most similar first.
+        """
+        trigrams = self.word_trigrams(word)
+        shared = Counter()
+        for trigram in trigrams:
+            words = self.trigrams.get(trigram)
+            if words and len(words) <= self.max_postings:
+                shared.update(words)
+        similar = []
+        for other, count in shared.items():
+            similarity = 2.0 * count / (
+                len(trigrams) + self.trigram_counts[other]
+            )
+            if similarity >= self.min_similarity:
+                similar.append((-similarity, other))
+        similar.sort()
+        return [other for similarity, other in similar[:self.max_similar]]
+
+    def postings_for(self, word):
+        """Find the items with a title word, or, if it's not in the
+        index, with a word spelled almost the same way.
+
+        :return: A list of positions, or None if there are none.
+        """
+        if word in self.postings:
+            return self.postings[word]
+        similar = self.similar_words(word)
+        if not similar:
+            return None
+        self.sizes.respelled += 1
+        if len(similar) == 1:
+            return self.postings[similar[0]]
+        return sorted(set().union(*(self.postings[x] for x in similar)))
+
+    def candidates(self, normalized_title):
+        """Find the items that might be a match for a title.
+
+        :return: A list of items, in the order they were added.
+        """
+        # The words are looked at in order so the weights below come
+        # out the same every time.
+        found = []
+        for word in sorted(self.words(normalized_title)):
+            postings = self.postings_for(word)
+            if postings:
+                found.append(postings)
+        usable = [x for x in found if len(x) <= self.max_postings]
+        if not usable and found:
+            # Every word in this title is very common. The best we can
+            # do is to go with the least common one.
+            usable = [min(found, key=len)]
+
+        shared = Counter()
+        for postings in usable:
+            shared.update(postings)
+        needed = max(1, int(math.ceil(self.min_shared * len(usable))))
+        positions = [x for x, count in shared.items() if count >= needed]
+        truncated = len(positions) > self.max_candidates
+        if truncated:
+            # Sharing a rare word says more than sharing a common
+            # one.
+            weight = defaultdict(float)
+            for postings in usable:
+                rarity = 1.0 / len(postings)
+                for x in postings:
+                    weight[x] += rarity
+            positions.sort(key=lambda x: (-weight[x], x))
+            positions = positions[:self.max_candidates]
+        positions.sort()
+        self.sizes.add(len(positions), truncated)
+        return [self.items[x] for x in positions]
+
+
+class Normalizer(object):
+    """Normalizes titles and names so they can be compared.
+
+    Normalized values are cached, so a Normalizer should be shared by
+    everything that needs to normalize the same titles and names. The
+    caches are bounded, so they can be sized to the memory available.
+    """
+
+    NON_ALPHABETIC = re.compile("[\W0-9]", re.I + re.UNICODE)
+    NON_ALPHANUMERIC = re.compile("[\W_]", re.I + re.UNICODE)
+    MULTIPLE_SPACES = re.compile("\s+")
+
+    GENERIC_TITLES = (
+        'annual report',
+        'special report',
+        'proceedings of',
+        'proceedings',
+        'general catalog',
+        'catalog',
+        'report',
+        'questions and answers',
+        'transactions',
+        'yearbook',
+        'year book',
+        'selected poems',
+        'poems',
+        'bulletin',
+        'papers',
+    )
+    GENERIC_TITLES_RE = re.compile("(%s)" % "|".join(GENERIC_TITLES))
+    TOTALLY_GENERIC_TITLES_RE = re.compile("^(%s)$" % "|".join(GENERIC_TITLES))
+
+    def __init__(self, title_cache_size=TITLE_CACHE_SIZE,
+                 name_cache_size=NAME_CACHE_SIZE):
+        self._normalized = lru_cache(maxsize=title_cache_size)(
+            self._normalize
+        )
+        self._normalized_names = lru_cache(maxsize=name_cache_size)(
+            self._normalize_name
+        )
+        self._name_words = lru_cache(maxsize=name_cache_size)(
+            self._split_name
+        )
+
+    def generic_title_penalties(self, title):
+        # A generic-looking title means that an author match 
+        # and a close date match is relatively more important.
+        title = self.normalize(title)
+        if "telephone director" in title:
+            # Telephone directories are uniquely awful, and they're
+            # published every year. Hold them to the highest standards.
+            return 7, 1.0, 7
+        if self.TOTALLY_GENERIC_TITLES_RE.match(title): 
+            return 6, 0.8, 5
+        if self.GENERIC_TITLES_RE.match(title):
+            return 4, 0.7, 4
+        return 1, 0, 1
+
+    def normalize(self, text):
+        if isinstance(text, list):
+            if len(text) == 2:
+                # title + subtitle
+                text = ": ".join(text)
+            else:
+                # book just has variant titles.
+                text = text[0]
+        return self._normalized(text)
+
+    def _normalize(self, text):
+        text = text.lower()
+
+        text = self.NON_ALPHANUMERIC.sub(" ", text)
+        text = self.MULTIPLE_SPACES.sub(" ", text)
+
+        # Just ignore these stopwords -- they're commonly missing or
+        # duplicated.
+        for ignorable in (
+            ' the ',
+            ' a ',
+            ' an ',
+        ):
+            text = text.replace(ignorable, '')
+        text = text.strip()
+        return text
+
+    def normalize_name(self, name):
+        if not name:
+            return None
+        return self._normalized_names(name)
+
+    def _normalize_name(self, name):
+        # Normalize a person's name.
+        name = name.lower()
+        name = self.NON_ALPHABETIC.sub(" ", name)
+        name = self.MULTIPLE_SPACES.sub(" ", name)
+        name = name.strip()
+        return name
+
+    def name_words(self, name):
+        if not name:
+            return None
+        return self._name_words(name)
+
+    def _split_name(self, name):
+        return sorted(name.split())
+
+    def title_key(self, normalized_title):
+        words = [x for x in normalized_title.split(" ") if x]
+        longest_words = sorted(words, key= lambda x: (-len(x), x))
+        return tuple(longest_words[:2])
+
+    def cache_report(self):
+        """Summarize how well the caches worked."""
+        lines = []
+        for name, cache in (
+            ("Titles", self._normalized),
+            ("Names", self._normalized_names),
+            ("Name words", self._name_words),
+        ):
+            info = cache.cache_info()
+            lookups = info.hits + info.misses
+            if lookups:
+                hit_rate = 100.0 * info.hits / lookups
+            else:
+                hit_rate = 0
+            # Nothing is ever removed from a cache except to make
+            # room, so every miss that isn't in the cache now was
+            # evicted.
+            evictions = info.misses - info.currsize
+            lines.append(
+                " %s: %d hits, %d misses (%.1f%% hit rate), %d evictions, %d/%d cached" % (
+                    name, info.hits, info.misses, hit_rate, evictions,
+                    info.currsize, info.maxsize
+                )
+            )
+        return "\n".join(lines)
+
+
+def title_distances(title, others):
+    """Find the Levenshtein distance between `title` and each of
+    `others`, all in one go if possible.
+    """
+    if rapidfuzz_process is None:
+        return [lev.distance(title, x) for x in others]
+    if numpy is not None:
+        return rapidfuzz_process.cdist(
+            [title], others, scorer=rapidfuzz_levenshtein.distance
+        )[0]
+    distances = [None] * len(others)
+    for other, distance, i in rapidfuzz_process.extract(
+        title, others, scorer=rapidfuzz_levenshtein.distance, limit=None
+    ):
+        distances[i] = distance
+    return distances
+
+
+class Scorer(object):
+    """Scores a registration against a whole block of candidate
+    matches at once.
+
+    Everything that depends only on the registration -- its
+    normalized title and authors, its best-guess registration date,
+    how generic its title is -- is worked out ahead of time by
+    Matcher.features. If NumPy is installed, the arithmetic for large
+    blocks is done on arrays.
+
+    Each Source scores matches slightly differently; the differences
+    are set up in the constructor.
+    """
+
+    # Blocks smaller than this aren't worth turning into arrays.
+    NUMPY_MIN_BLOCK = 64
+
+    def __init__(self, normalizer, year_exponent, missing_author_penalty,
+                 author_penalty_cap, short_title_penalty):
+        """
+        :param normalizer: Used to normalize names, and to judge how
+            generic a title is.
+        :param year_exponent: The exponential element of the penalty
+            for each year between registration and publication.
+        :param missing_author_penalty: The penalty when either side
+            has no author information.
+        :param author_penalty_cap: The largest penalty for a mismatch
+            between authors.
+        :param short_title_penalty: Whether the bonus for an exact
+            title match is smaller for short titles.
+        """
+        self.normalizer = normalizer
+        self.year_exponent = year_exponent
+        self.missing_author_penalty = missing_author_penalty
+        self.author_penalty_cap = author_penalty_cap
+        self.short_title_penalty = short_title_penalty
+        self._year_penalties = []
+
+    def score(self, features, candidates):
+        """Score a registration against a block of candidates.
+
+        :param features: The registration's features, from
+            Matcher.features.
+        :param candidates: A list of (normalized title, year, author)
+            tuples, one for each candidate.
+        :return: A list with the quality of each match.
+        """
+        if not candidates:
+            return []
+        titles, years, authors = zip(*candidates)
+        author_penalties = self.author_penalties(features, authors)
+        use_numpy = numpy is not None and len(candidates) >= self.NUMPY_MIN_BLOCK
+        if use_numpy:
+            title_qualities = self.title_qualities(features, titles, numpy.array)
+            date_penalties = self.date_penalties(features, years, numpy.array)
+            qualities = (
+                title_qualities - date_penalties - numpy.array(author_penalties)
+            )
+            return qualities.tolist()
+        title_qualities = self.title_qualities(features, titles)
+        date_penalties = self.date_penalties(features, years)
+        return [
+            title_quality - date_penalty - author_penalty
+            for title_quality, date_penalty, author_penalty in zip(
+                title_qualities, date_penalties, author_penalties
+            )
+        ]
+
+    def exact_match_quality(self, title):
+        """The quality of a perfect title match. There's a bonus --
+        unless the title is short or generic. That's not very
+        impressive.
+
+        Note that this looks at the registration's original title,
+        not its normalized title.
+        """
+        a, b, c = self.normalizer.generic_title_penalties(title)
+        length_multiplier = 1
+        if self.short_title_penalty and len(title) < 15:
+            length_multiplier = 1- ((15 - len(title)) * 0.05)
+        if a == 1:
+            # Not generic.
+            return 1.2 * length_multiplier
+        else:
+            # Generic.
+            return 1 * length_multiplier
+
+    def title_qualities(self, features, titles, array=None):
+        """The basic quality evaluation is based on title similarity."""
+        registration_title = features['title']
+        if not registration_title:
+            qualities = [-1] * len(titles)
+            if array:
+                return array(qualities, dtype=float)
+            return qualities
+
+        # Calculate the Levenshtein distance between the two strings,
+        # as a proportion of the length of the longer string.
+        #
+        # This ~ the quality of the title match.
+        #
+        # If you have to change half of the characters to get from one
+        # string to another, that's a score of 50%, which isn't
+        # "okay", it's really bad.  Multiply the distance by a
+        # constant to reflect this.
+        distances = title_distances(registration_title, titles)
+        title_length = len(registration_title)
+        exact = self.exact_match_quality(features['original_title'])
+        if array:
+            distances = array(distances, dtype=float) * 1.5
+            lengths = array([len(x) for x in titles])
+            qualities = 1 - (distances / numpy.maximum(lengths, title_length))
+            qualities[array([x == registration_title for x in titles])] = exact
+            return qualities
+
+        qualities = []
+        for title, distance in zip(titles, distances):
+            if title == registration_title:
+                qualities.append(exact)
+                continue
+            longer_string = max(len(title), title_length)
+            qualities.append(1-((distance * 1.5) / float(longer_string)))
+        return qualities
+
+    def year_penalty(self, difference):
+        """The penalty for a given number of years between the
+        registration and publication dates.
+        """
+        penalties = self._year_penalties
+        while len(penalties) <= difference:
+            years = len(penalties)
+            if years == 0:
+                # Exact match gets a slight negative penalty -- a bonus.
+                penalties.append(-0.01)
+            else:
+                # Apply a penalty for every year of difference. The
+                # penalty has a slight exponential element -- 5 years
+                # in either direction really should be enough for a
+                # match.
+                penalties.append((years ** self.year_exponent) * 0.1)
+        return penalties[difference]
+
+    def date_penalties(self, features, years, array=None):
+        """A penalty is applied if the publication date is far away
+        from the copyright registration date.
+        """
+        registration_year = features['year']
+        if registration_year is None:
+            # We don't know the registration date; there will be no
+            # penalty.
+            penalties = [0] * len(years)
+            if array:
+                return array(penalties, dtype=float)
+            return penalties
+
+        multiplier = features['year_multiplier']
+        if array:
+            differences = abs(array(years) - registration_year)
+            self.year_penalty(int(differences.max()))
+            penalties = array(self._year_penalties)[differences]
+            penalties[penalties > 0] *= multiplier
+            return penalties
+
+        penalties = []
+        for year in years:
+            penalty = self.year_penalty(abs(year - registration_year))
+            if penalty > 0:
+                penalty *= multiplier
+            penalties.append(penalty)
+        return penalties
+
+    def author_penalties(self, features, authors):
+        """A penalty is applied if the authors are clearly divergent."""
+        penalties = []
+        cache = {}
+        for author in authors:
+            if isinstance(author, list):
+                key = tuple(author)
+            else:
+                key = author
+            if key not in cache:
+                cache[key] = self.author_penalty(features, author)
+            penalties.append(cache[key])
+        return penalties
+
+    def author_penalty(self, features, authors):
+        if features['has_authors'] and authors:
+            # Return the smallest penalty for the given list of
+            # authors.
+            if not isinstance(authors, list):
+                authors = [authors]
+            penalties = []
+            for author in authors:
+                for name, words in features['names']:
+                    penalty = self.author_mismatch(author, name, words)
+                    if penalty is not None:
+                        penalties.append(penalty)
+            if penalties:
+                # This will find the largest negative penalty (bonus)
+                # or the smallest positive penalty.
+                penalty = min(penalties)
+            else:
+                # We couldn't figure it out. No penalty.
+                penalty = 0
+        else:
+            penalty = self.missing_author_penalty
+
+        # A generic-looking title needs an author match.
+        if penalty == 0:
+            return features['author_base_penalty']
+        elif penalty > 0:
+            return penalty * features['author_multiplier']
+        return penalty
+
+    def author_mismatch(self, author, registration_name, registration_words):
+        """Determine the size of the rating penalty due to the
+        mismatch between two authors.
+        """
+        name = self.normalizer.normalize_name(author)
+        if not name:
+            # We just don't know.
+            return None
+
+        if name == registration_name:
+            # Exact match gets a negative penalty -- a bonus.
+            return -0.25
+
+        if self.normalizer.name_words(name) == registration_words:
+            # These are probably the same author. Return a negative
+            # penalty -- a bonus.
+            return -0.2
+
+        distance = lev.distance(name, registration_name)
+        longer_string = max(len(name), len(registration_name))
+        proportional_changes = distance / float(longer_string)
+        penalty = 1 - proportional_changes
+
+        if penalty > 0:
+            # Beyond "a couple typoes", the Levenshtein distance
+            # basically means there's no match, so the penalty is
+            # capped.
+            penalty = min(penalty, self.author_penalty_cap)
+        return penalty
+
+
+class Source(object):
+    """A source of scanned books to match registrations against.
+
+    Subclasses find the books, say how to score them (SCORER), and
+    how to describe a match in the output (output()).
+    """
+
+    # What this source is called in reports.
+    NAME = None
+
+    # Where matches against this source are written.
+    OUTPUT = None
+
+    # Settings for this source's Scorer.
+    SCORER = {}
+
+    def __init__(self, normalizer, index=None):
+        """
+        :param normalizer: A Normalizer, ideally shared with the
+            Matcher and any other Sources.
+        :param index: A TokenIndex to use for finding candidate
+            matches. By default, candidates are found by title_key.
+        """
+        self.normalizer = normalizer
+        self.by_title_key = defaultdict(list)
+        self.index = index
+        if index:
+            self.sizes = index.sizes
+        else:
+            self.sizes = CandidateSizes()
+        self.scorer = Scorer(normalizer, **self.SCORER)
+
+    def add(self, normalized_title, item):
+        """Make a book available for matching."""
+        if self.index:
+            self.index.add(normalized_title, item)
+        else:
+            key = self.normalizer.title_key(normalized_title)
+            self.by_title_key[key].append(item)
+
+    def candidates(self, registration_title):
+        """Find everything that might match a (normalized) title."""
+        if self.index:
+            return self.index.candidates(registration_title)
+        key_matches = self.by_title_key.get(
+            self.normalizer.title_key(registration_title), []
+        )
+        self.sizes.add(len(key_matches))
+        return key_matches
+
+    def candidate_features(self, item):
+        """The (normalized title, year, author) of a candidate, for
+        the Scorer.
+        """
+        raise NotImplementedError()
+
+    def matches(self, candidates, features):
+        """Score a registration against its candidates.
+
+        :return: A list of (candidate, quality) 2-tuples for the
+            candidates that might be a match.
+        """
+        qualities = self.scorer.score(
+            features, [self.candidate_features(x) for x in candidates]
+        )
+        return [
+            (item, quality) for item, quality in zip(candidates, qualities)
+            if quality > 0
+        ]
+
+    def output(self, registration, item, quality):
+        """Describe a match, for the output file."""
+        raise NotImplementedError()
+
+
+def hathifile_cache_key(hathi_text_file):
+    """A stamp that changes whenever the Hathifile, or the code
+    that decides which entries to keep, changes.
+
+    Hashing a multi-gigabyte Hathifile would take longer than loading
+    the cache saves, so the Hathifile is identified by its path, size
+    and modification time.
+    """
+    key = hashlib.sha1(str(CUTOFF_YEAR).encode("ascii"))
+    with open(__file__, "rb") as f:
+        key.update(f.read())
+    stat = os.stat(hathi_text_file)
+    key.update(repr(
+        (os.path.abspath(hathi_text_file), stat.st_size, stat.st_mtime_ns)
+    ).encode("utf8"))
+    return key.hexdigest()
+
+def hathifile_ranges(hathi_text_file, count):
+    """Divide an uncompressed Hathifile into `count` pieces, each of
+    which starts at the beginning of a line.
+
+    :return: A list of (path, start, end) 3-tuples, with byte offsets.
+    """
+    size = os.stat(hathi_text_file).st_size
+    starts = [0]
+    with open(hathi_text_file, "rb") as f:
+        for i in range(1, count):
+            f.seek(size * i // count)
+            f.readline()
+            starts.append(max(f.tell(), starts[-1]))
+    ends = starts[1:] + [size]
+    return [
+        (hathi_text_file, start, end)
+        for start, end in zip(starts, ends) if start < end
+    ]
+
+def filter_hathifile(hathi_text_file, processes=1):
+    """Find the Hathifile entries that might be matches for a
+    registration.
+
+    An uncompressed Hathifile is divided up among `processes` worker
+    processes, each of which reads and filters its own part of the
+    file. A gzipped Hathifile can only be decompressed from start to
+    finish, and handing its lines to other processes costs about as
+    much as filtering them, so it's always filtered in this process.
+
+    :yield: A (ht_bib_key, title, author, year, row) tuple for each
+        entry, in the order they appear in the Hathifile.
+    """
+    # Lines end at "\n" and nowhere else, however the file is read,
+    # so the output is the same however many processes are used.
+    if hathi_text_file.endswith(".gz"):
+        with gzip.open(hathi_text_file, "rt", newline="\n") as f:
+            for entry in filter_hathifile_lines(f):
+                yield entry
+        return
+    if processes <= 1:
+        with open(hathi_text_file, newline="\n") as f:
+            for entry in filter_hathifile_lines(f):
+                yield entry
+        return
+
+    # A few ranges per process keeps them all busy until the end.
+    pool = Pool(processes)
+    for entries in pool.imap(
+        filter_hathifile_range,
+        hathifile_ranges(hathi_text_file, processes * 4)
+    ):
+        for entry in entries:
+            yield entry
+    pool.close()
+    pool.join()
+
+def filter_hathifile_range(piece):
+    """Filter one range of bytes from the Hathifile.
+
+    This runs inside a worker process.
+
+    :return: A list of entries, as yielded by filter_hathifile.
+    """
+    path, start, end = piece
+
+    def lines():
+        position = start
+        with open(path, "rb") as f:
+            f.seek(start)
+            for raw in f:
+                yield raw.decode("utf8")
+                position += len(raw)
+                if position >= end:
+                    break
+    return list(filter_hathifile_lines(lines()))
+
+def filter_hathifile_lines(lines):
+    """Filter lines from the Hathifile.
+
+    :yield: An entry for each line worth considering, as yielded by
+        filter_hathifile.
+    """
+    for raw in lines:
+        row = raw.strip().split("\t")
+        try:
+            htid,access,rights,ht_bib_key,description,source,source_bib_num,oclc_num,isbn,issn,lccn,title,imprint,rights_reason_code,rights_timestamp,us_gov_doc_flag,rights_date_used,pub_place,lang,bib_fmt,collection_code,content_provider_code,responsible_entity_code,digitization_agent_code,access_profile_code,author = row
+        except Exception as e:
+            continue
+
+        if bib_fmt != 'BK':
+            # Not a book proper
+            continue
+            
+        # Already open access?
+        if us_gov_doc_flag != '0':
+            continue
+        if rights in ['pdus', 'pd']:
+            continue
+            
+        # und?
+        if rights not in ['ic', 'und']:
+            continue
+                
+        try:
+            year = int(rights_date_used)
+        except Exception as e:
+            continue
+        if year > 1963+5 or year < CUTOFF_YEAR:
+            # Don't consider works published more than 5 years out
+            # of the range we're considering. That's plenty of
+            # time to publish the work you registered, or to register
+            # the work you published.
+            continue
+
+        yield (ht_bib_key, title, author, year, row)
+
+class HathiSource(Source):
+    """Books from a Hathifile."""
+
+    NAME = "Hathi Trust"
+    OUTPUT = "output/hathi-0-matched.ndjson"
+
+    # The Hathifile entries worth considering are cached here.
+    CACHE = "output/hathi-0-hathifile-cache.pickle"
+
+    SCORER = dict(
+        # Missing author data gets a slight penalty.
+        year_exponent=1.15, missing_author_penalty=0.2,
+        author_penalty_cap=0.50, short_title_penalty=True,
+    )
+
+    def __init__(self, normalizer, hathi_text_file, index=None, processes=1):
+        """
+        :param processes: The number of processes to use when reading
+            the Hathifile.
+        """
+        Source.__init__(self, normalizer, index)
+        # The title_key blocks aren't needed when there's an index.
+        self.entries, by_title_key = self.load(
+            hathi_text_file, processes, by_title_key=not self.index
+        )
+        if self.index:
+            for entry in self.entries:
+                self.index.add(entry[1], entry)
+        else:
+            self.by_title_key.update(by_title_key)
+
+    def load(self, hathi_text_file, processes=1, by_title_key=True):
+        """Find the Hathifile entries that might be matches for a
+        registration.
+
+        The result is cached in CACHE, keyed on the Hathifile's path,
+        size and modification time and on the matching code, so this
+        only has to be done once for any given Hathifile.
+
+        :param by_title_key: Whether to also group the entries by
+            title_key.
+        :return: A 2-tuple (entries, by_title_key). `entries` is a
+            list of (ht_bib_key, normalized title, normalized author,
+            year, hathi_dict, row) tuples, in the order they appear in
+            the Hathifile. `by_title_key` is a dictionary of those
+            entries, keyed by title_key, or None if it wasn't asked
+            for.
+        """
+        key = hathifile_cache_key(hathi_text_file)
+        entries = keyed = None
+        if os.path.exists(self.CACHE):
+            with open(self.CACHE, "rb") as f:
+                if pickle.load(f) == key:
+                    # Building a lot of objects at once sets off the
+                    # garbage collector over and over, for nothing.
+                    gc.disable()
+                    try:
+                        entries = pickle.load(f)
+                        if by_title_key:
+                            keyed = pickle.load(f)
+                    finally:
+                        gc.enable()
+            if entries is not None and (keyed is not None or not by_title_key):
+                return entries, keyed
+
+        if entries is None:
+            entries = []
+            for ht_bib_key, title, author, year, row in filter_hathifile(
+                hathi_text_file, processes
+            ):
+                hathi_dict = dict(
+                    title=title, author=author, identifier=ht_bib_key,
+                    year=year
+                )
+
+                title = self.normalizer.normalize(title)
+                author = self.normalizer.normalize(author)
+                if not title:
+                    continue
+                entry = (ht_bib_key, title, author, year, hathi_dict, row)
+                entries.append(entry)
+        if by_title_key:
+            keyed = defaultdict(list)
+            for entry in entries:
+                keyed[self.normalizer.title_key(entry[1])].append(entry)
+            keyed = dict(keyed)
+
+        # The title_key blocks are saved if they were made, so a later
+        # run that needs them doesn't have to make them.
+        partial = "%s.%d" % (self.CACHE, os.getpid())
+        with open(partial, "wb") as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(keyed, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, self.CACHE)
+        return entries, keyed
+
+    def candidate_features(self, entry):
+        ht_bib_key, title, author, year, hathi_dict, row = entry
+        return title, year, author
+
+    def output(self, registration, entry, quality):
+        hathi_dict = entry[-2]
+        return dict(
+            quality=quality, hathi=hathi_dict, cce=registration.jsonable()
+        )
+
+
+class IASource(Source):
+    """Books from the Internet Archive, as found by ia-0-list-texts.py."""
+
+    NAME = "Internet Archive"
+    OUTPUT = "output/ia-1-matched.ndjson"
+
+    ALREADY_OPEN = set([
+        "http://rightsstatements.org/vocab/NKC/1.0/"
+    ])
+
+    # Government authors whose work should either be already public
+    # domain or whose work probably wasn't copyrighted, and whose
+    # Internet Archive documents clutter up the matching code.
+    IGNORE_AUTHORS = set([
+        "Central Intelligence Agency"
+    ])
+
+    SCORER = dict(
+        # Author mismatches are quite common, so we don't usually
+        # make a big deal of them.
+        year_exponent=1.1, missing_author_penalty=0,
+        author_penalty_cap=0.20, short_title_penalty=False,
+    )
+
+    def __init__(self, normalizer, ia_text_file="output/ia-0-texts.ndjson",
+                 index=None):
+        Source.__init__(self, normalizer, index)
+        for i, raw in enumerate(open(ia_text_file)):
+            data = codec.loads(raw)
+            license_url = data.get('licenseurl')
+            if license_url and (
+                    'creativecommons.org' in license_url
+                    or license_url in self.ALREADY_OPEN
+            ):
+                # This is already open-access; don't consider it.
+                continue
+
+            year = data.get('year')
+            if int(year) > 1963+5 or int(year) < CUTOFF_YEAR:
+                # Don't consider works published more than 5 years out
+                # of the range we're considering. That's plenty of
+                # time to publish the work you registered, or to register
+                # the work you published.
+                continue
+
+            authors = data.get('creator', [])
+            if not isinstance(authors, list):
+                authors = [authors]
+            if any(author in self.IGNORE_AUTHORS for author in authors):
+                continue
+            title = data['title']
+            title = self.normalizer.normalize(title)
+            if not title:
+                continue
+            self.add(title, data)
+
+    def candidate_features(self, data):
+        return (
+            self.normalizer.normalize(data['title']), int(data['year']),
+            data.get('creator')
+        )
+
+    def output(self, registration, data, quality):
+        return dict(quality=quality, ia=data, cce=registration.jsonable())
+
+
+class Matcher(object):
+    """Matches registrations against any number of Sources in a
+    single pass.
+    """
+
+    def __init__(self, normalizer, sources, metrics=None):
+        """
+        :param normalizer: The Normalizer shared by all the Sources.
+        :param metrics: A Metrics to keep track of the matching with.
+        """
+        self.normalizer = normalizer
+        self.sources = sources
+        self.metrics = metrics or Metrics()
+
+    def features(self, registration, registration_title):
+        """Work out everything about a registration that's needed to
+        score it against a candidate from any source.
+        """
+        normalize = self.normalizer.normalize
+        normalize_name = self.normalizer.normalize_name
+
+        registration_date = registration.best_guess_registration_date
+        if registration_date:
+            year = registration_date.year
+        else:
+            year = None
+
+        registration_authors = registration.authors or []
+        if not isinstance(registration_authors, list):
+            registration_authors = [registration_authors]
+        names = []
+        for author in registration_authors:
+            name = normalize_name(author)
+            if name:
+                names.append((name, self.normalizer.name_words(name)))
+
+        # A generic-looking title means that an author match and a
+        # close date match are relatively more important.
+        author_multiplier, author_base_penalty, year_multiplier = (
+            self.normalizer.generic_title_penalties(registration_title)
+        )
+
+        return dict(
+            title=normalize(registration_title),
+            original_title=registration.title,
+            year=year,
+            has_authors=bool(registration_authors),
+            names=names,
+            author_multiplier=author_multiplier,
+            author_base_penalty=author_base_penalty,
+            year_multiplier=year_multiplier,
+        )
+
+    def match(self, registration):
+        """Match one registration against every source.
+
+        :yield: A (source, output data) 2-tuple for each likely match.
+        """
+        title = registration.title
+        if not title or not self.normalizer.normalize(title):
+            return
+        registration_title = self.normalizer.normalize(title)
+        features = None
+        for source in self.sources:
+            candidates = source.candidates(registration_title)
+            if not candidates:
+                continue
+            if features is None:
+                features = self.features(registration, registration_title)
+            self.metrics.gauge("%s candidates" % source.NAME, len(candidates))
+            matches = source.matches(candidates, features)
+
+            # If there are a huge number of matches for a CCE title,
+            # penalize them -- it's probably a big mess that must be dealt
+            # with separately. Give a slight boost if there's only a single
+            # match.
+            if len(matches) == 1:
+                num_matches_coefficient = 1.1
+            elif len(matches) <= MATCH_CUTOFF:
+                num_matches_coefficient = 1
+            else:
+                num_matches_coefficient = 1-(
+                    len(matches) - MATCH_CUTOFF/float(MATCH_CUTOFF)
+                )
+            for item, quality in matches:
+                quality = quality * num_matches_coefficient
+                if quality <= QUALITY_CUTOFF:
+                    continue
+                yield source, source.output(registration, item, quality)
+
+    def run(self):
+        """Match every unrenewed registration against every source,
+        writing each source's matches to its OUTPUT file.
+        """
+        outputs = dict((source, open(source.OUTPUT, "w")) for source in self.sources)
+        parse = self.metrics.phase("parse")
+        match = self.metrics.phase("match")
+        write = self.metrics.phase("write")
+        for filename in ["FINAL-not-renewed.ndjson"]: #"FINAL-possibly-renewed.ndjson"]:
+            for i in open("output/%s" % filename):
+                with parse:
+                    cce = Registration.from_json(codec.loads(i))
+                with match:
+                    matches = list(self.match(cce))
+                with write:
+                    for source, output_data in matches:
+                        codec.dump(output_data, outputs[source])
+                self.metrics.record()
+        for output in outputs.values():
+            output.close()
+
+    def report(self):
+        """Summarize the candidates found in each source, and how well
+        the normalization caches worked.
+        """
+        lines = [
+            "%s: %s" % (source.NAME, source.sizes.report())
+            for source in self.sources
+        ]
+        lines.append("Normalization caches:")
+        lines.append(self.normalizer.cache_report())
+        return "\n".join(lines)
@@ -0,0 +1,208 @@
+"""Measure how fast a script is going, and where the time goes.
+
+Each script keeps a Metrics object, and tells it about every record it
+finishes with (record()), the time it spends on each phase of its work
+(phase()), and the sizes of its queues and batches (gauge()). Every
+REPORT_EVERY records, the usual "10000 1.23sec" progress line is
+printed. When the script is done, finish() writes everything to
+output/metrics/[script].json, where bench-1-run.py (or anything else)
+can pick it up.
+
+Setting the CCE_PROFILE environment variable runs cProfile over a
+window of records, so the hot spots of a real run can be found without
+running the whole thing under a profiler:
+
+  CCE_PROFILE=200000:10000 python 3-filter.py
+
+profiles records 200000 through 209999 and saves the profile to
+output/metrics/[script].prof. CCE_PROFILE=10000 profiles the first
+10000 records. Only the script's main process is profiled.
+"""
+import cProfile
+import datetime
+import os
+import sys
+import time
+import codec
+
+METRICS_DIR = "output/metrics"
+
+# How often to print a progress line, in records.
+REPORT_EVERY = 10000
+
+
+class Phase(object):
+    """Times one phase of a script's work, every time it's entered.
+
+    Phases may be nested, but a phase can't be entered again while
+    it's already running. Time spent in a nested phase is counted in
+    the phase around it too, so phases that are reported side by side
+    shouldn't be nested.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += time.perf_counter() - self.started
+        self.calls += 1
+
+    def jsonable(self):
+        return dict(calls=self.calls, seconds=self.seconds)
+
+
+class Gauge(object):
+    """Keeps track of the values seen for some size, like the number of
+    items waiting in a queue.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def jsonable(self):
+        return dict(
+            count=self.count, mean=self.total / float(self.count or 1),
+            min=self.min, max=self.max
+        )
+
+
+class Metrics(object):
+
+    def __init__(self, name=None, report_every=REPORT_EVERY):
+        """
+        :param name: The name of the script, which names its metrics
+            file. A Metrics with no name can't be finished; it's for
+            code that keeps metrics nobody asked for.
+        :param report_every: How often to print a progress line, in
+            records, or None to never print one.
+        """
+        self.name = name
+        self.report_every = report_every
+        self.count = 0
+        self.started = time.time()
+        self.last_report = self.started
+        self.phases = {}
+        self.gauges = {}
+
+        # The record counts at which to start and stop profiling.
+        self.profile = None
+        self.profile_start = self.profile_stop = float("inf")
+        window = os.environ.get("CCE_PROFILE")
+        if window and name:
+            if ":" in window:
+                start, length = window.split(":", 1)
+                self.profile_start = int(start)
+            else:
+                length = window
+                self.profile_start = 0
+            self.profile_stop = self.profile_start + int(length)
+            self.check_profile()
+
+    def record(self, count=1):
+        """Note that `count` more records have been processed."""
+        before = self.count
+        self.count += count
+        if self.count >= self.profile_start:
+            self.check_profile()
+        if self.report_every and (
+            self.count // self.report_every != before // self.report_every
+        ):
+            now = time.time()
+            print("%d %.2fsec" % (self.count, now-self.last_report))
+            self.last_report = now
+
+    def phase(self, name):
+        """A context manager that times one phase of the work.
+
+        with metrics.phase("parse"):
+            ...
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase()
+        return phase
+
+    def gauge(self, name, value):
+        """Note the current value of some size."""
+        gauge = self.gauges.get(name)
+        if gauge is None:
+            gauge = self.gauges[name] = Gauge()
+        gauge.add(value)
+
+    def merge(self, phases):
+        """Add in phase timings from another Metrics -- one kept by a
+        worker process, say.
+
+        :param phases: A dictionary like the "phases" in a metrics
+            file.
+        """
+        for name, data in phases.items():
+            phase = self.phase(name)
+            phase.calls += data['calls']
+            phase.seconds += data['seconds']
+
+    def jsonable(self):
+        seconds = time.time() - self.started
+        return dict(
+            name=self.name,
+            started=datetime.datetime.fromtimestamp(
+                self.started, datetime.timezone.utc
+            ).isoformat(),
+            arguments=sys.argv[1:],
+            seconds=seconds,
+            records=self.count,
+            records_per_second=self.count / (seconds or 1),
+            phases=dict((k, v.jsonable()) for k, v in self.phases.items()),
+            gauges=dict((k, v.jsonable()) for k, v in self.gauges.items()),
+        )
+
+    def path(self, extension):
+        return os.path.join(METRICS_DIR, self.name + extension)
+
+    def check_profile(self):
+        """Start or stop the profiler, if it's time."""
+        if self.profile is None and self.profile_start <= self.count < self.profile_stop:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.profile is not None and self.count >= self.profile_stop:
+            self.stop_profile()
+
+    def stop_profile(self):
+        self.profile.disable()
+        if not os.path.exists(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+        self.profile.dump_stats(self.path(".prof"))
+        print("Profile saved to %s" % self.path(".prof"))
+        self.profile = None
+        self.profile_start = float("inf")
+
+    def finish(self):
+        """Write out the metrics for this run.
+
+        :return: The metrics, as written.
+        """
+        if self.profile is not None:
+            self.stop_profile()
+        data = self.jsonable()
+        if not os.path.exists(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+        with open(self.path(".json"), "w") as out:
+            codec.dump(data, out)
+        return data
@@ -1,18 +1,175 @@
-from pdb import set_trace
+# lxml and dateutil take a while to import, and most scripts never
+# need them -- only 0-parse-registrations.py parses XML, and nearly
+# every date is parsed without dateutil's help -- so they're imported
+# the first time they're needed rather than up front.
+import calendar
 import datetime
-from dateutil import parser as date_parser
 import json
+import os
 import re
+import sys
+from collections import defaultdict
+from functools import lru_cache
+
+# The list of the world's countries.
+COUNTRIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "countries.json")
+
+# Compiled etree.XPath objects, keyed by the path they evaluate. The
+# same handful of paths are run against every entry, so there's no
+# need for lxml to compile them over and over.
+_compiled_xpaths = {}
+
+# Stands in for a value that was never provided.
+_MISSING = object()
+
+# The CCE uses the same raw date strings over and over, so remember
+# how each one was parsed. This is the maximum number of raw strings
+# to remember.
+DATE_CACHE_SIZE = 100000
+
+# Places of publication repeat even more than dates. This is the
+# maximum number of places to remember a verdict for.
+PLACE_CACHE_SIZE = 100000
+
+# The same notes and previous publications come up again and again.
+# This is the maximum number of them to remember the rules for.
+NOTE_CACHE_SIZE = 100000
+
+# The date formats that make up almost all of the CCE: "1958-06-19",
+# "1958-06", and "19Jun58".
+ISO_DATE = re.compile("^([0-9]{4})-([0-9]{2})(?:-([0-9]{2}))?$")
+CCE_DATE = re.compile("^([0-9]{1,2})([A-Z][a-z]{2})([0-9]{2})$")
+MONTHS = dict(
+    (name, i+1) for i, name in enumerate(
+        "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+    )
+)
+
+def _fast_parse_date(raw):
+    """Parse one of the common CCE date formats without going through
+    dateutil.
+
+    The result is exactly what date_parser.parse would return for the
+    same string, including dateutil's habits of taking a missing day
+    from today's date and of putting a two-digit year within 50
+    years of the current year.
+
+    :return: A datetime, or None if `raw` isn't in one of the common
+        formats (or isn't a valid date), in which case dateutil should
+        have a go at it.
+    """
+    try:
+        match = ISO_DATE.match(raw)
+        if match:
+            year, month, day = match.groups()
+            year = int(year)
+            month = int(month)
+            if day:
+                return datetime.datetime(year, month, int(day))
+            today = datetime.date.today()
+            day = min(today.day, calendar.monthrange(year, month)[1])
+            return datetime.datetime(year, month, day)
+
+        match = CCE_DATE.match(raw)
+        if match:
+            day, month, year = match.groups()
+            month = MONTHS.get(month)
+            if not month:
+                return None
+            this_year = datetime.date.today().year
+            year = int(year) + (this_year // 100 * 100)
+            if year >= this_year + 50:
+                year -= 100
+            elif year < this_year - 50:
+                year += 100
+            return datetime.datetime(year, month, int(day))
+    except ValueError as e:
+        return None
+    return None
+
+def _any_case(text):
+    """A regular expression that matches wherever `text` would be
+    found in a string that had been lowercased.
+
+    Unlike re.I, this doesn't let the letters of `text` match
+    non-ASCII letters like the dotless i.
+    """
+    return "".join(
+        "[%s%s]" % (c, c.upper()) if c.isalpha() else re.escape(c)
+        for c in text
+    )
+
+def _from_normalized(normalized):
+    """Turn a date that's already been normalized to %Y-%m-%d format
+    back into a datetime.
+    """
+    return datetime.datetime(
+        int(normalized[:4]), int(normalized[5:7]), int(normalized[8:10])
+    )
+
+def _dateutil_parse(raw):
+    """Parse a date with dateutil."""
+    from dateutil import parser as date_parser
+    return date_parser.parse(raw)
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date_string(raw):
+    """Turn a raw CCE date string into a datetime, or None if it
+    doesn't look like a plausible date.
+    """
+    parsed = None
+    # Try to parse the full date, and parse just the year and
+    # month if that fails. In most cases that's all we really
+    # need.
+    attempts = [raw]
+    if len(raw) > 7 and raw[7] == '-':
+        attempts.append(raw[:7])
+    for attempt in attempts:
+        try:
+            parsed = _fast_parse_date(attempt) or _dateutil_parse(attempt)
+            if not parsed:
+                continue
+            if parsed.year > 2000 and len(raw) in (6, 7):
+                # A very common date format is '19Jun58',
+                # which date_parser parses as 2059. Subtract
+                # 100 years and we're in business.
+                parsed = datetime.datetime(
+                    parsed.year-100, parsed.month, parsed.day
+                )
+            if parsed.year > 1995 or parsed.year < 1900:
+                # This is most likely a totally incorrect date, or
+                # not a date at all.
+                parsed = None
+            else:
+                break
+        except ValueError as e:
+            continue
+    return parsed
 
 class XMLParser(object):
     """Helper methods for running XPath queries."""
 
+    @classmethod
+    def find(cls, tag, path):
+        """Find all tags matching `path`, relative to `tag`.
+
+        :param tag: An etree Element, or a Children object that has
+            already sorted an Element's children by name.
+        """
+        if isinstance(tag, Children):
+            return tag.find(path)
+        compiled = _compiled_xpaths.get(path)
+        if compiled is None:
+            from lxml import etree
+            compiled = _compiled_xpaths[path] = etree.XPath(path)
+        return compiled(tag)
+
     @classmethod
     def xpath(cls, tag, path):
         """Find all child tags matching `path` and return a list of all
         non-empty text nodes within.
         """
-        results = tag.xpath(path)
+        results = cls.find(tag, path)
         return [x.text for x in results if x.text]
 
     @classmethod
@@ -20,7 +177,7 @@ class XMLParser(object):
         """Find a single child tag matching `path` and return
         its text node, if any.
         """
-        results = tag.xpath(path)
+        results = self.find(tag, path)
         if not results:
             return None
         return results[0].text
@@ -38,7 +195,7 @@ class XMLParser(object):
 
     @classmethod
     def date(cls, tag, path, allow_multiple=False, warnings=None):
-        results = tag.xpath(path)
+        results = cls.find(tag, path)
         if not results:
             if allow_multiple:
                 return []
@@ -72,38 +229,46 @@ class XMLParser(object):
 
     @classmethod
     def _parse_date(cls, raw, warnings=None):
-        parsed = None
-        # Try to parse the full date, and parse just the year and
-        # month if that fails. In most cases that's all we really
-        # need.
-        attempts = [raw]
-        if len(raw) > 7 and raw[7] == '-':
-            attempts.append(raw[:7])
-        for attempt in attempts:
-            try:
-                parsed = date_parser.parse(attempt)
-                if not parsed:
-                    continue
-                if parsed.year > 2000 and len(raw) in (6, 7):
-                    # A very common date format is '19Jun58',
-                    # which date_parser parses as 2059. Subtract
-                    # 100 years and we're in business.
-                    parsed = datetime.datetime(
-                        parsed.year-100, parsed.month, parsed.day
-                    )
-                if parsed.year > 1995 or parsed.year < 1900:
-                    # This is most likely a totally incorrect date, or
-                    # not a date at all.
-                    parsed = None
-                else:
-                    break
-            except ValueError as e:
-                continue
+        parsed = _parse_date_string(raw)
         if not parsed and warnings is not None:
             msg = "Could not parse date %s" % raw
             warnings.append(msg)
         return parsed
 
+
+class Children(object):
+    """The children of a tag, sorted by tag name in a single pass.
+
+    This can stand in for the tag itself when a lot of simple XPath
+    queries ("title", "author/authorName") are going to be run
+    against it: each query becomes a dictionary lookup instead of a
+    scan through all of the tag's children.
+    """
+
+    SIMPLE_PATH = re.compile("^[A-Za-z_][-.\\w]*(/[A-Za-z_][-.\\w]*)*$")
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.attrib = tag.attrib
+        self.by_name = defaultdict(list)
+        for child in tag:
+            # Skip comments and processing instructions.
+            if isinstance(child.tag, str):
+                self.by_name[child.tag].append(child)
+
+    def find(self, path):
+        if not self.SIMPLE_PATH.match(path):
+            return XMLParser.find(self.tag, path)
+        name, _, rest = path.partition("/")
+        tags = self.by_name.get(name, [])
+        if not rest:
+            return list(tags)
+        results = []
+        for tag in tags:
+            results.extend(XMLParser.find(tag, rest))
+        return results
+
+
 class Publisher(XMLParser):
     """Represents information about the publisher(s) associated with a
     Registration, and the time and circumstances of publication.
@@ -134,8 +299,10 @@ class Publisher(XMLParser):
         return cls(**data)
 
     @classmethod
-    def from_tag(cls, publisher, warnings=None):
+    def from_tag(cls, publisher, warnings=None, single_pass=False):
         """Parse publisher information from a <publisher> tag."""
+        if single_pass:
+            publisher = Children(publisher)
         extra = dict(publisher.attrib)
         pub_dates = cls.date(
             publisher, "pubDate", allow_multiple=True,
@@ -144,7 +311,7 @@ class Publisher(XMLParser):
         places = cls.xpath(publisher, "pubPlace")
         claimants = []
         nonclaimants = []
-        for publisher_name_tag in publisher.xpath("pubName"):
+        for publisher_name_tag in cls.find(publisher, "pubName"):
             name = publisher_name_tag.text
             is_claimant = publisher_name_tag.attrib.get('claimant')
             if is_claimant == 'yes':
@@ -168,35 +335,75 @@ class Places(object):
         ]
     )
 
-    def __init__(self):
-        self.foreign_countries = set()
-        self.foreign_country_endings = set()
-        for i in json.load(open("countries.json"))['countries']:
-            if i not in ("United States Of America", "Georgia"):
-                self.foreign_countries.add(i)
-                self.foreign_country_endings.add(", " + i)
-        for name in ('England', 'Scotland', 'Eng.', 'U.K.', 'UK'):
-            self.foreign_countries.add(name)
-            self.foreign_country_endings.add(", " + name)
+    # Finds any of the FOREIGN_CITIES anywhere in a string.
+    FOREIGN_CITY = re.compile(
+        "|".join(re.escape(x) for x in sorted(FOREIGN_CITIES))
+    )
+
+    def __init__(self, path=COUNTRIES):
+        """
+        :param path: Where to find the list of countries. It isn't
+            read until a place needs to be looked up.
+        """
+        self.path = path
+        self._foreign_countries = None
+
+        # The same places come up over and over, so remember the
+        # verdict for each one.
+        self._verdicts = lru_cache(maxsize=PLACE_CACHE_SIZE)(
+            self._is_foreign
+        )
+
+    @property
+    def foreign_countries(self):
+        if self._foreign_countries is None:
+            foreign_countries = set()
+            with open(self.path) as f:
+                for i in json.load(f)['countries']:
+                    if i not in ("United States Of America", "Georgia"):
+                        foreign_countries.add(i)
+            for name in ('England', 'Scotland', 'Eng.', 'U.K.', 'UK'):
+                foreign_countries.add(name)
+            self._foreign_countries = foreign_countries
+        return self._foreign_countries
 
     def is_foreign(self, place):
         """Make a best guess as to whether a place name is in
         another country.
         """
+        return self._verdicts(place)
+
+    def _is_foreign(self, place):
         if place.endswith('.'):
             place = place[:1]
         if place in self.FOREIGN_CITIES:
             return True
         if place in self.foreign_countries:
             return True
-        if ',' in place and any(x in place for x in self.FOREIGN_CITIES):
+        if ',' in place and self.FOREIGN_CITY.search(place):
             # This will incorrectly flag "London, Ontario" but it will
             # correctly flag "London, New York", which is more common.
             return True
-        if any(place.endswith(x) for x in self.foreign_country_endings):
+        if self.ends_with_country(place):
             return True
         return False
 
+    def ends_with_country(self, place):
+        """Does `place` end with ", " followed by the name of a
+        foreign country?
+
+        Rather than trying every country against the end of the
+        string, this looks up whatever follows each ", " in the
+        string.
+        """
+        foreign_countries = self.foreign_countries
+        i = place.find(", ")
+        while i != -1:
+            if place[i+2:] in foreign_countries:
+                return True
+            i = place.find(", ", i+1)
+        return False
+
 
 class Registration(XMLParser):
 
@@ -208,7 +415,8 @@ class Registration(XMLParser):
             publishers=None, previous_regnums=None, previous_publications=None,
             new_matter_claimed=None, extra=None, parent=None, children=None,
             xrefs=None, _is_foreign=None, warnings=None,
-            error=None, disposition=None, renewals=None
+            error=None, disposition=None, renewals=None,
+            best_guess_date=_MISSING
     ):
         self.uuid = uuid
         self.regnums = [x for x in (regnums or []) if x]
@@ -229,6 +437,12 @@ class Registration(XMLParser):
         self.disposition = disposition
         self.renewals = renewals
 
+        # The best guess at the registration date, in %Y-%m-%d format,
+        # or None if there's no usable date. This is worked out when
+        # the registration is first parsed (see normalize_dates()); if
+        # it's _MISSING, it's worked out from the dates as needed.
+        self.best_guess_date = best_guess_date
+
     def jsonable(self, include_others=True, compact=False, require_disposition=False):
         data = dict(
             uuid=self.uuid,
@@ -273,6 +487,10 @@ class Registration(XMLParser):
             for k in list(data.keys()):
                 if not data[k]:
                     del data[k]
+        if self.best_guess_date is not _MISSING:
+            # This is kept even if it's None, since None means there
+            # is no usable date, not that nobody's looked.
+            data['best_guess_date'] = self.best_guess_date
         return data
 
     def _json(self, x, compact=False, **kwargs):
@@ -300,8 +518,32 @@ class Registration(XMLParser):
     def from_json(cls, data):
         return cls(**data)
 
+    def copy(self, **kwargs):
+        """Make a new Registration from this one's jsonable() form, as
+        though it had been written out and read back in.
+
+        The parts of a registration that get changed as it's
+        processed -- the warnings, the 'extra' dictionary, and the
+        date dictionaries -- are copied, so that work done on the copy
+        doesn't show up in this registration, or vice versa.
+
+        :param kwargs: Passed into jsonable().
+        """
+        data = self.jsonable(**kwargs)
+        data['warnings'] = list(data['warnings'])
+        data['extra'] = dict(data['extra'])
+        data['reg_dates'] = [dict(x) for x in data['reg_dates']]
+        publishers = []
+        for publisher in data['publishers']:
+            publisher = dict(publisher)
+            if 'dates' in publisher:
+                publisher['dates'] = [dict(x) for x in publisher['dates']]
+            publishers.append(publisher)
+        data['publishers'] = publishers
+        return self.from_json(data)
+
     @classmethod
-    def from_tag(cls, tag, parent=None, include_extra=True):
+    def from_tag(cls, tag, parent=None, include_extra=True, single_pass=False):
 
         """Turn a <copyrightEntry> or <additionalEntry> tag into a sequence of
         Registration objects.
@@ -315,9 +557,15 @@ class Registration(XMLParser):
         :param include_extra: Parse out information that's not currently
                used in to determine renewal status.
 
+        :param single_pass: Sort the tag's children by name in a
+               single pass, instead of running a separate XPath query
+               for every field. The result is the same either way.
+
         :yield: A single Registration for an <additionalEntry> tag;
                 one or more for a <copyrightEntry> tag.
         """
+        if single_pass:
+            tag = Children(tag)
         warnings = []
         uuid = tag.attrib.get('id', None)
         regnums = tag.attrib.get('regnum', '').split()
@@ -330,8 +578,8 @@ class Registration(XMLParser):
         authors = cls.xpath(tag, "author/authorName")
         notes = cls.xpath(tag, 'note')
         publishers = [
-            Publisher.from_tag(publisher_tag, warnings)
-            for publisher_tag in tag.xpath("publisher")
+            Publisher.from_tag(publisher_tag, warnings, single_pass)
+            for publisher_tag in cls.find(tag, "publisher")
         ]
         previous_regnums = cls.xpath(tag, "prev-regNum")
         previous_publications = cls.xpath(tag, "prevPub")
@@ -349,7 +597,7 @@ class Registration(XMLParser):
                 'page', 'copyDate',
             ]:
                 tags = []
-                for extra_tag in tag.xpath(name):
+                for extra_tag in cls.find(tag, name):
                     tags.append(cls._package(extra_tag))
                 if tags:
                     extra[name] = tags
@@ -362,10 +610,15 @@ class Registration(XMLParser):
             extra=extra, parent=parent, warnings=warnings,
             new_matter_claimed=new_matter_claimed
         )
+        registration.normalize_dates(
+            reg_dates, [date for p in publishers for date in p.dates]
+        )
 
         children = []
-        for child_tag in tag.xpath("additionalEntry"):
-            for child_registration in cls.from_tag(child_tag, registration):
+        for child_tag in cls.find(tag, "additionalEntry"):
+            for child_registration in cls.from_tag(
+                child_tag, registration, single_pass=single_pass
+            ):
                 registration.children.append(child_registration)
 
         yield registration
@@ -380,6 +633,53 @@ class Registration(XMLParser):
     PREVIOUSLY_REGISTERED = re.compile("[pd]rev[.,]? reg", re.I)
     PREVIOUSLY_SOMETHING = re.compile("[pd]rev[.,i]", re.I)
 
+    # Keywords in a note or previous publication that suggest a
+    # foreign publication, and the names of the NOTE_RULES that find
+    # them. They're checked in this order.
+    FOREIGN_KEYWORDS = [
+        ('abroad', 'abroad'),
+        ('american ed.', 'american_ed'),
+        ('american edition', 'american_edition'),
+    ]
+
+    # Every rule that is_foreign and previously_published apply to a
+    # note or previous publication, in a single regular expression.
+    # The match is a lookahead, so it's tried at every position of
+    # the string, and rules whose matches overlap all get found.
+    # Rules that can match at the same position are listed from most
+    # to least important. Every rule starts with one of the letters in
+    # the first lookahead, which lets most positions be ruled out
+    # quickly.
+    NOTE_RULES = re.compile(
+        "(?=[pdPDaA])(?=(?:"
+        "(?P<published_abroad>(?i:%s))"
+        "|(?P<published>(?i:%s))"
+        "|(?P<registered>(?i:%s))"
+        "|(?P<something>(?i:%s))"
+        "|(?P<interim>AI[.-])"
+        "|(?P<abroad>%s)"
+        "|(?P<american_ed>%s)"
+        "|(?P<american_edition>%s)"
+        "))" % (
+            PREVIOUSLY_PUBLISHED_ABROAD.pattern, PREVIOUSLY_PUBLISHED.pattern,
+            PREVIOUSLY_REGISTERED.pattern, PREVIOUSLY_SOMETHING.pattern,
+            _any_case("abroad"), _any_case("american ed."),
+            _any_case("american edition"),
+        )
+    )
+
+    @staticmethod
+    @lru_cache(maxsize=NOTE_CACHE_SIZE)
+    def note_rules(value):
+        """Find every one of the NOTE_RULES that matches a note or
+        previous publication.
+
+        :return: A frozenset of rule names.
+        """
+        return frozenset(
+            match.lastgroup for match in Registration.NOTE_RULES.finditer(value)
+        )
+
     def _regnum_is_foreign(self, regnum):
         if any(regnum.startswith(x) for x in self.FOREIGN_PREFIXES):
             self.warnings.append(
@@ -408,17 +708,18 @@ class Registration(XMLParser):
             return True
 
         for note in self.notes:
-            if self.PREVIOUSLY_PUBLISHED.search(note):
+            rules = self.note_rules(note)
+            if 'published' in rules:
                 self.warnings.append(
                     "Note (%r) seems to mention a previous publication, which must be checked manually." % note
                 )
                 return True
-            if self.PREVIOUSLY_REGISTERED.search(note):
+            if 'registered' in rules:
                 self.warnings.append(
                     "Note (%r) seems to mention a previous registration, which must be checked manually." % note
                 )
                 return True
-            if self.PREVIOUSLY_SOMETHING.search(note):
+            if 'something' in rules:
                 self.warnings.append(
                     "Note (%r) seems to mention... something... happening previously, most likely a publication or registration. This must be checked manually." % note
                 )
@@ -451,10 +752,11 @@ class Registration(XMLParser):
                 ("Note", self.notes)
         ):
             for value in values:
-                if self.PREVIOUSLY_PUBLISHED_ABROAD.search(value):
+                rules = self.note_rules(value)
+                if 'published_abroad' in rules:
                     self.warnings.append("%s %r indicates work was previously published abroad." % (field, value))
                     return True
-                if 'AI.' in value or 'AI-' in value:
+                if 'interim' in rules:
                     self.warnings.append(
                         "%s '%s' seems to mention an interim registration." % (field, value)
                     )
@@ -475,11 +777,9 @@ class Registration(XMLParser):
                 ("Note", self.notes)
         ):
             for value in values:
-                p = value.lower()
-                for keyword in [
-                        'abroad', 'american ed.', 'american edition'
-                ]:
-                    if keyword in p:
+                rules = self.note_rules(value)
+                for keyword, rule in self.FOREIGN_KEYWORDS:
+                    if rule in rules:
                         self.warnings.append(
                             "%s %r mentions the keyword '%s', which indicates this _may_ have originally been a foreign publication." % (
                                 field, value, keyword
@@ -579,10 +879,52 @@ class Registration(XMLParser):
             regnums=[regnum], reg_dates=reg_dates, notes=[note]
         )
 
-    def _normalize_date(self, date):
+    def normalize_dates(self, reg_dates, pub_dates):
+        """Parse every registration and publication date, once, and
+        make a best guess at the registration date.
+
+        Each date dictionary gets a '_normalized' or '_error' key, and
+        the best guess goes into best_guess_date, so later steps never
+        have to parse these dates again. As before, a publication date
+        that can't be parsed is only warned about if the publication
+        dates are needed for the best guess.
+
+        :param reg_dates: The registration dates, as dictionaries.
+        :param pub_dates: The publication dates, as dictionaries.
+        """
+        reg = [
+            x for x in (self._normalize_date(d) for d in reg_dates) if x
+        ]
+        if reg:
+            warnings = None
+        else:
+            warnings = self.warnings
+        pub = [
+            x for x in (
+                self._normalize_date(d, warnings) for d in pub_dates
+            ) if x
+        ]
+        best_guess = min(reg or pub or [None])
+        if best_guess:
+            best_guess = best_guess.isoformat()[:10]
+        self.best_guess_date = best_guess
+
+    def _normalize_date(self, date, warnings=_MISSING):
+        """Parse a date dictionary, noting the result in the dictionary.
+
+        A date that's already been parsed isn't parsed again, and
+        isn't warned about again.
+        """
         if not date:
             return None
-        parsed = self._parse_date(date['_text'], self.warnings)
+        normalized = date.get('_normalized')
+        if normalized:
+            return _from_normalized(normalized)
+        if '_error' in date:
+            return None
+        if warnings is _MISSING:
+            warnings = self.warnings
+        parsed = self._parse_date(date['_text'], warnings)
         if parsed:
             date['_normalized'] = parsed.isoformat()[:10]
         else:
@@ -606,6 +948,10 @@ class Registration(XMLParser):
 
     @property
     def best_guess_registration_date(self):
+        if self.best_guess_date is not _MISSING:
+            if self.best_guess_date:
+                return _from_normalized(self.best_guess_date)
+            return None
         reg = list(self.registration_dates)
         if reg:
             return min(reg)
@@ -650,40 +996,93 @@ class Registration(XMLParser):
         return False
 
 class Renewal(object):
+    """A renewal record.
+
+    There are hundreds of thousands of these in memory at once while
+    registrations are being matched against them, so the data is kept
+    in fixed slots instead of a per-instance dictionary, and the short
+    strings that repeat between renewals (dates, authors, titles) are
+    interned so that each distinct value is only stored once.
+    """
 
     csv_row_labels = 'renewal_id renewal_date renewal_registration registration_date renewal_title renewal_author'.split()
 
+    # The fields of a renewal, in the order jsonable() lists them.
+    FIELDS = (
+        'uuid', 'regnum', 'reg_date', 'renewal_id', 'renewal_date',
+        'author', 'title', 'new_matter', 'see_also_renewal',
+        'see_also_registration', 'full_text',
+    )
+    INTERNED_FIELDS = set([
+        'regnum', 'reg_date', 'renewal_date', 'author', 'title', 'new_matter'
+    ])
+
+    # 'regnum' is a property, so the raw value is stored as '_regnum'.
+    SLOTS = dict((x, x) for x in FIELDS)
+    SLOTS['regnum'] = '_regnum'
+    __slots__ = tuple(SLOTS.values()) + ('_extra',)
+
     def __init__(self, **data):
-        self.data = data
+        # Any fields we don't know about are kept in a dictionary.
+        self._extra = None
+        for k, v in data.items():
+            if k in self.INTERNED_FIELDS and isinstance(v, str):
+                v = sys.intern(v)
+            slot = self.SLOTS.get(k)
+            if slot:
+                setattr(self, slot, v)
+            else:
+                if self._extra is None:
+                    self._extra = dict()
+                self._extra[k] = v
+
+    def get(self, k, default=None):
+        slot = self.SLOTS.get(k)
+        if slot:
+            return getattr(self, slot, default)
+        return (self._extra or {}).get(k, default)
 
     def jsonable(self):
-        return self.data
+        data = dict()
+        for k, slot in self.SLOTS.items():
+            v = getattr(self, slot, _MISSING)
+            if v is not _MISSING:
+                data[k] = v
+        if self._extra:
+            data.update(self._extra)
+        return data
 
     @property
     def renewal_key(self):
         def to_set(x):
             return Registration(Registration._normalize_text(x).split())
-        return (to_set(self.data['title']), to_set(self.data['author']))
+        return (to_set(self.title), to_set(self.author))
     
     def __getattr__(self, k):
-        return self.data[k]
+        # Only called for fields that were never set.
+        if k == '_extra':
+            raise AttributeError(k)
+        extra = self._extra
+        if extra and k in extra:
+            return extra[k]
+        raise AttributeError(k)
 
     @property
     def csv_row(self):
         return [
-            self.data.get('renewal_id'),
-            self.data.get('renewal_date'),
+            self.get('renewal_id'),
+            self.get('renewal_date'),
             self.regnum,
-            self.data.get('reg_date'),
-            self.data.get('title'),
-            self.data.get('author'),
+            self.get('reg_date'),
+            self.get('title'),
+            self.get('author'),
         ]
 
     REG_NUMBER = re.compile("A[A-Z]?-?[0-9]+")
 
     @property
     def regnum(self):
-        r = self.data.get('regnum', None)
+        r = self.get('regnum', None)
         if isinstance(r, list):
             return ", ".join(r)
         return r